@@ -25,24 +25,47 @@
 
 import bpy
 import bpy_types
+import hashlib
+import json
 import math
+import multiprocessing
+import operator
 import os
+import re
+import shutil
+import threading
 import time
 import subprocess
 import mathutils
+from array import array
 from mathutils import Matrix, Vector, Quaternion
 
 from . import bl_info
 
 from .util import bpy_newer_257
+from .util import clamp
 from .util import BlenderVersionError
-from .util import rib, rib_path, rib_ob_bounds
+from .util import rib_path, rib_ob_bounds
 from .util import make_frame_path
 from .util import init_env
 from .util import get_sequence_path
 from .util import user_path
 from .util import get_path_list_converted
 from .util import path_list_convert
+from .util import rna_fingerprint
+
+from .rib_output import open_rib
+from .rib_output import compressed_path
+from .rib_output import FragmentPool
+from .rib_output import write_shards
+
+from .fragment_cache import FragmentCache
+
+from .motion import MotionStore
+
+from .jobs import JobScheduler
+
+from .frustum import Frustum, any_contains_box, box_corners
 
 addon_version = bl_info['version']
 
@@ -77,6 +100,26 @@ class RPass:
         self.options = []
 
         self.emit_photons = False
+        
+        self.fragment_cache = None
+        self.lod_cache = None
+        self.shared_caches = False
+        
+        # archives the RIB reads, see record_archive_read()
+        self.archive_reads = {}
+        
+        # ObjectInstance handles of objects sharing a mesh, by object name
+        self.instances = {}
+        
+        # scheduler for pre-pass renders, and the pre-pass outputs this pass reads
+        self.jobs = None
+        self.dependencies = set()
+        self.threads = None
+        
+        # view frustums to cull objects against, or None to export everything,
+        # and the objects they culled
+        self.frustums = None
+        self.culled = []
     
         self.resolution = []
         self.motion_blur = scene.renderman.motion_blur
@@ -235,7 +278,7 @@ def renderable_objects(scene):
 
 # Generate an automatic path to write an archive when 'Export as Archive' is enabled
 def auto_archive_path(paths, objects, create_folder=False):
-    filename = objects[0].name + ".rib"
+    filename = objects[0].name + paths['rib_extension']
     
     if os.getenv("ARCHIVE") != None:
         archive_dir = os.getenv("ARCHIVE")
@@ -275,8 +318,10 @@ def archive_objects(scene):
 def get_subframes(segs):
     return [i * 1.0/segs for i in range(segs+1)]
 
-def get_ob_subframes(scene, ob):
-    if ob.renderman.motion_segments_override:
+def get_ob_subframes(scene, ob, motion=None):
+    if motion != None and ob.name in motion['segments']:
+        return get_subframes(motion['segments'][ob.name])
+    elif ob.renderman.motion_segments_override:
         return get_subframes(ob.renderman.motion_segments)
     else:
         return get_subframes(scene.renderman.motion_segments)
@@ -290,8 +335,18 @@ def is_subd_displace_last(ob):
     return (ob.modifiers[len(ob.modifiers)-2].type == 'SUBSURF' and
         ob.modifiers[len(ob.modifiers)-1].type == 'DISPLACE')
 
+# a subsurf followed by a displace can't be left to the renderer without a
+# displacement shader to match the modifier, so those are exported as
+# polygons, fully evaluated
 def is_subdmesh(ob):
-    return (is_subd_last(ob) or is_subd_displace_last(ob))
+    return is_subd_last(ob)
+
+# trailing subsurf modifier of a subdivision mesh, which is left for the
+# renderer to do rather than applied to the exported mesh
+def subd_modifier(ob):
+    if is_subd_last(ob):
+        return ob.modifiers[len(ob.modifiers)-1]
+    return None
 
 # XXX do this better, perhaps by hooking into modifier type data in RNA?
 # Currently assumes too much is deforming when it isn't
@@ -371,33 +426,41 @@ def get_particles(scene, ob, psys):
     
     return (P, rot, width)
 
+# displacement over one frame of each particle, from its velocity (in units per second)
+def get_particle_velocity(scene, ob, psys):
+    V = []
+    fps = scene.render.fps / scene.render.fps_base
+    
+    cfra = scene.frame_current
+    
+    for pa in [p for p in psys.particles if valid_particle(p, cfra)]:
+        V.extend( pa.velocity / fps )
+    
+    return array('f', V)
+
 # Mesh data access
+#
+# Bulk access via foreach_get() into typed arrays. This copies straight out
+# of blender's internal arrays rather than walking every vertex/loop in python.
 def get_mesh(mesh):
-    nverts = []
-    verts = []
-    P = []
+    nverts = array('i', [0]) * len(mesh.polygons)
+    verts = array('i', [0]) * len(mesh.loops)
+    P = array('f', [0.0]) * (len(mesh.vertices) * 3)
     
-    for v in mesh.vertices:
-        P.extend( v.co )
-  
-    for p in mesh.polygons:
-        nverts.append( p.loop_total )
-        verts.extend( p.vertices )
+    mesh.polygons.foreach_get('loop_total', nverts)
+    mesh.loops.foreach_get('vertex_index', verts)
+    mesh.vertices.foreach_get('co', P)
         
     return (nverts, verts, P)
 
 def get_mesh_vertex_N(mesh):
-    N = []
-    
-    for v in mesh.vertices:
-        N.extend( v.normal )
+    N = array('f', [0.0]) * (len(mesh.vertices) * 3)
+    mesh.vertices.foreach_get('normal', N)
     
     return N
 
 # requires facevertex interpolation
 def get_mesh_uv(mesh, name=""):
-    uvs = []
-
     if name == "":
         uv_loop_layer = mesh.uv_layers.active
     else:
@@ -408,9 +471,11 @@ def get_mesh_uv(mesh, name=""):
     if uv_loop_layer == None:
         return None
     
-    for uvloop in uv_loop_layer.data:
-        uvs.append( uvloop.uv.x )
-        uvs.append( 1.0 - uvloop.uv.y )     # renderman expects UVs flipped vertically from blender
+    uvs = array('f', [0.0]) * (len(uv_loop_layer.data) * 2)
+    uv_loop_layer.data.foreach_get('uv', uvs)
+    
+    # renderman expects UVs flipped vertically from blender
+    uvs[1::2] = array('f', map((1.0).__sub__, uvs[1::2]))
 
     return uvs
 
@@ -418,13 +483,12 @@ def get_mesh_uv(mesh, name=""):
 # requires facevertex interpolation
 def get_mesh_vcol(mesh, name=""):
     vcol_layer = mesh.vertex_colors[name] if name != "" else mesh.vertex_colors.active
-    cols = []
     
     if vcol_layer == None:
         return None
     
-    for vcloop in vcol_layer.data:
-        cols.extend( vcloop.color )
+    cols = array('f', [0.0]) * (len(vcol_layer.data) * 3)
+    vcol_layer.data.foreach_get('color', cols)
     
     return cols
 
@@ -445,7 +509,11 @@ def get_mesh_vgroup(ob, mesh, name=""):
     return weights
 
 
-def export_primvars(file, ob, geo, interpolation=""):
+def exports_normals(ob):
+    return (ob.type == 'MESH' and ob.data.renderman.export_smooth_normals and 
+            ob.renderman.primitive in ('AUTO', 'POLYGON_MESH', 'SUBDIVISION_MESH'))
+
+def export_primvars(file, ob, geo, interpolation="", normals=True):
     if ob.type != 'MESH':
         return
 
@@ -454,35 +522,35 @@ def export_primvars(file, ob, geo, interpolation=""):
     interpolation = 'facevertex' if interpolation == '' else interpolation
     
     # default hard-coded prim vars
-    if rm.export_smooth_normals and ob.renderman.primitive in ('AUTO', 'POLYGON_MESH', 'SUBDIVISION_MESH'):
+    if normals and exports_normals(ob):
         N = get_mesh_vertex_N(geo)
         if N is not None:
-            file.write('            "varying normal N" %s \n' % rib(N) )
+            file.param_array('varying normal N', N)
     if rm.export_default_uv:
         uvs = get_mesh_uv(geo)
         if uvs is not None:
-            file.write('            "%s float[2] st" %s \n' % (interpolation, rib(uvs)) )
+            file.param_array('%s float[2] st' % interpolation, uvs)
     if rm.export_default_vcol:
         vcols = get_mesh_vcol(geo)
         if vcols is not None:
-            file.write('            "%s color Cs" %s \n' % (interpolation, rib(vcols)) )
+            file.param_array('%s color Cs' % interpolation, vcols)
     
     # custom prim vars
     for p in rm.prim_vars:
         if p.data_source == 'VERTEX_COLOR':
             vcols = get_mesh_vcol(geo, p.data_name)
             if vcols is not None:
-                file.write('            "%s color %s" %s \n' % (interpolation, p.name, rib(vcols)) )
+                file.param_array('%s color %s' % (interpolation, p.name), vcols)
 
         elif p.data_source == 'UV_TEXTURE':
             uvs = get_mesh_uv(geo, p.data_name)
             if uvs is not None:
-                file.write('            "%s float[2] %s" %s \n' % (interpolation, p.name, rib(uvs)) )
+                file.param_array('%s float[2] %s' % (interpolation, p.name), uvs)
 
         elif p.data_source == 'VERTEX_GROUP':
             weights = get_mesh_vgroup(ob, geo, p.data_name)
             if weights is not None:
-                file.write('            "vertex float %s" %s \n' % (p.name, rib(weights)) )
+                file.param_array('vertex float %s' % p.name, weights)
     
 def export_primvars_particle(file, scene, psys):
     rm = psys.settings.renderman
@@ -499,7 +567,7 @@ def export_primvars_particle(file, scene, psys):
                 for pa in [p for p in psys.particles if valid_particle(p, cfra)]:
                     vars.extend ( pa.angular_velocity )
 
-            file.write('            "varying float[3] %s" %s \n' % (p.name, rib(vars)) )
+            file.param_array('varying float[3] %s' % p.name, vars)
 
         elif p.data_source in ('SIZE', 'AGE', 'BIRTH_TIME', 'DIE_TIME', 'LIFE_TIME'):
             if p.data_source == 'SIZE':
@@ -518,7 +586,7 @@ def export_primvars_particle(file, scene, psys):
                 for pa in [p for p in psys.particles if valid_particle(p, cfra)]:
                     vars.append ( pa.lifetime )
 
-            file.write('            "varying float %s" %s \n' % (p.name, rib(vars)) )
+            file.param_array('varying float %s' % p.name, vars)
 
 
 def get_fluid_mesh(scene, ob):
@@ -533,10 +601,24 @@ def get_fluid_mesh(scene, ob):
     bpy.data.meshes.remove(mesh)
     
     # use fluid vertex velocity vectors to reconstruct moving points
-    P = [P[i] + fluidmeshverts[int(i/3)].velocity[i%3] * subframe * 0.5 for i in range(len(P))]
+    velocity = array('f', [0.0]) * len(P)
+    fluidmeshverts.foreach_get('velocity', velocity)
+    
+    scale = subframe * 0.5
+    P = array('f', map(lambda p, v: p + v * scale, P, velocity))
     
     return (nverts, verts, P)
     
+# displacement over one frame of each fluid mesh vertex, matching get_fluid_mesh()
+def get_fluid_velocity(ob):
+    fluidmod = [m for m in ob.modifiers if m.type == 'FLUID_SIMULATION'][0]
+    fluidmeshverts = fluidmod.settings.fluid_mesh_vertices
+    
+    velocity = array('f', [0.0]) * (len(fluidmeshverts) * 3)
+    fluidmeshverts.foreach_get('velocity', velocity)
+    
+    return array('f', map(lambda v: v * 0.5, velocity))
+
 def get_subd_creases(mesh):
     creases = []
     
@@ -546,17 +628,29 @@ def get_subd_creases(mesh):
             creases.append( (e.vertices[0], e.vertices[1], e.crease*e.crease * 10) ) # squared, to match blender appareance better : range 0 - 10 (infinitely sharp)
     return creases
 
+# Mesh of an object evaluated with its modifier stack changed by edit(modifiers).
+# The changes are made on a temporary copy of the object, so the user's own
+# modifiers are never touched, and linked objects work too.
+def create_mesh_with(scene, ob, edit):
+    tmp = ob.copy()
+    try:
+        edit(tmp.modifiers)
+        mesh = tmp.to_mesh(scene, True, 'RENDER')
+    finally:
+        bpy.data.objects.remove(tmp)
+    return mesh
+
 def create_mesh(scene, ob, matrix=None):
-    # 2 special cases to ignore:
-    # subsurf last or subsurf 2nd last +displace last
-    
-    #if is_subd_last(ob):
-    #    ob.modifiers[len(ob.modifiers)-1].show_render = False
-    #elif is_subd_displace_last(ob):
-    #    ob.modifiers[len(ob.modifiers)-2].show_render = False
-    #    ob.modifiers[len(ob.modifiers)-1].show_render = False
-    
-    mesh = ob.to_mesh(scene, True, 'RENDER')    
+    # special case for subdivision meshes with a trailing subsurf:
+    # the cage is exported instead, for the renderer to subdivide
+    subsurf = None
+    if detect_primitive(ob) == 'SUBDIVISION_MESH':
+        subsurf = subd_modifier(ob)
+    
+    if subsurf != None and subsurf.show_render:
+        mesh = create_mesh_with(scene, ob, lambda modifiers: modifiers.remove(modifiers[len(modifiers)-1]))
+    else:
+        mesh = ob.to_mesh(scene, True, 'RENDER')
     
     if matrix != None:
         mesh.transform(matrix)
@@ -564,6 +658,172 @@ def create_mesh(scene, ob, matrix=None):
     return mesh
 
 
+# ------------- Fragment Cache -------------
+
+def open_fragment_cache(scene, paths):
+    rm = scene.renderman
+    if not rm.fragment_cache:
+        return None
+    
+    return FragmentCache(user_path(rm.path_fragment_cache, scene=scene),
+                        extension=paths['rib_extension'],
+                        max_size=rm.fragment_cache_size*1024*1024)
+
+# Manifest of rendered shadow maps and the hash of the RIB they were rendered from.
+# Shadow maps live with the rest of the export, the manifest is only kept so
+# unchanged maps don't need rendering again.
+def open_shadowmap_cache(scene, paths):
+    if not scene.renderman.shadowmap_cache:
+        return None
+    
+    return FragmentCache(os.path.join(paths['export_dir'], 'shadowmap_cache'))
+
+def save_cache(cache):
+    if cache is None:
+        return
+    
+    cache.save()
+    print(cache.stats_report())
+
+# When exporting a frame, the fragment and LOD caches are shared by all its
+# passes and only saved once they've all been written. Saving evicts whatever
+# the passes didn't use, and a pass saving its own cache would evict fragments
+# the other passes' RIB (maybe still rendering in the background) reads.
+def open_pass_caches(rpass, scene, evaluation=None):
+    if evaluation != None:
+        rpass.fragment_cache = evaluation.fragment_cache
+        rpass.lod_cache = evaluation.lod_cache
+        rpass.shared_caches = True
+    else:
+        rpass.fragment_cache = open_fragment_cache(scene, rpass.paths)
+
+def close_fragment_cache(rpass):
+    if not rpass.shared_caches:
+        save_cache(rpass.lod_cache)
+        save_cache(rpass.fragment_cache)
+    
+    rpass.fragment_cache = None
+    rpass.lod_cache = None
+
+# same tests as export_motion_ob(), without having to sample the motion
+def has_motion(ob):
+    return (ob.animation_data != None or ob.constraints or is_dupli(ob) or
+            len(ob.particle_systems) > 0 or is_deforming(ob) or is_deforming_fluid(ob))
+
+# objects whose RIB only depends on their state at the current frame
+def fragment_cacheable(scene, ob, motion):
+    if is_dupli(ob) or len(ob.particle_systems) > 0:
+        return False
+    # the levels are cached separately, and could be evicted from under the fragment
+    if lod_object(scene, ob, motion):
+        return False
+    # delayed archives are written per frame, a fragment reused from an
+    # earlier frame would go on reading that frame's archive
+    if delayed_archive(scene, ob, motion):
+        return False
+    if ob.renderman.geometry_source != 'BLENDER_SCENE_DATA':
+        return False
+    if ob.name in motion['transformation'] or ob.name in motion['deformation']:
+        return False
+    if ob.name in motion['velocity']:
+        return False
+    return True
+
+def mesh_fingerprint(h, ob, mesh, prim):
+    for data in get_mesh(mesh):
+        h.update(data.tobytes())
+    
+    smooth = array('i', [0]) * len(mesh.polygons)
+    mesh.polygons.foreach_get('use_smooth', smooth)
+    h.update(smooth.tobytes())
+    
+    for layer in mesh.uv_layers:
+        uvs = array('f', [0.0]) * (len(layer.data) * 2)
+        layer.data.foreach_get('uv', uvs)
+        h.update(layer.name.encode())
+        h.update(uvs.tobytes())
+    
+    for layer in mesh.vertex_colors:
+        cols = array('f', [0.0]) * (len(layer.data) * 3)
+        layer.data.foreach_get('color', cols)
+        h.update(layer.name.encode())
+        h.update(cols.tobytes())
+    
+    for p in ob.data.renderman.prim_vars:
+        if p.data_source == 'VERTEX_GROUP':
+            h.update(repr(get_mesh_vgroup(ob, mesh, p.data_name)).encode())
+    
+    if prim == 'SUBDIVISION_MESH':
+        h.update(repr(get_subd_creases(mesh)).encode())
+
+def material_fingerprint(h, mat):
+    h.update(mat.name.encode())
+    h.update(repr((tuple(mat.diffuse_color), mat.alpha, mat.preview_render_type)).encode())
+    rna_fingerprint(h, mat.renderman)
+    
+    if mat.renderman.nodetree != '':
+        rna_fingerprint(h, bpy.data.node_groups.get(mat.renderman.nodetree))
+
+# Hash of everything that goes into an object's RIB: the render pass,
+# transform, evaluated geometry, materials and renderman settings
+def object_fingerprint(rpass, scene, ob, motion=None):
+    h = hashlib.sha1()
+    srm = scene.renderman
+    
+    h.update(repr((addon_version, rpass.type, rpass.emit_photons,
+                rpass.surface_shaders, rpass.displacement_shaders, rpass.interior_shaders,
+                rpass.atmosphere_shaders, rpass.light_shaders,
+                srm.rib_format, srm.rib_float_precision,
+                rpass.paths.get('export_dir'), rpass.paths.get('gi_ptc_bake_path'),
+                ob in rpass.archives, srm.delayed_archives, srm.delayed_archive_vertices)).encode())
+    
+    h.update(ob.name.encode())
+    if ob.parent:
+        mat = ob.parent.matrix_world * ob.matrix_local
+    else:
+        mat = ob.matrix_world
+    h.update(repr([tuple(row) for row in mat]).encode())
+    
+    rna_fingerprint(h, ob.renderman)
+    if ob.data and hasattr(ob.data, 'renderman'):
+        rna_fingerprint(h, ob.data.renderman)
+    
+    # light linking is only written for lamps that are rendered
+    for light in ob.renderman.light_linking:
+        lamp = scene.objects.get(light.light)
+        h.update(repr((light.light, lamp != None and is_renderable(scene, lamp))).encode())
+    
+    if adaptive_shading(rpass, scene) and not ob.renderman.shadingrate_override:
+        h.update(repr(adaptive_shading_rate(scene, ob, motion)).encode())
+    
+    prim = detect_primitive(ob)
+    h.update(prim.encode())
+    
+    if ob.name in rpass.instances:
+        # the shared mesh is written with every export, only the handle is in the fragment
+        h.update(rpass.instances[ob.name].encode())
+    elif prim in ('POLYGON_MESH', 'SUBDIVISION_MESH', 'POINTS'):
+        # without modifiers or shape keys, the mesh datablock is what gets exported
+        if ob.type == 'MESH' and len(ob.modifiers) == 0 and ob.data.shape_keys == None:
+            mesh_fingerprint(h, ob, ob.data, prim)
+        elif motion != None:
+            # keep the mesh for export_object() to write
+            mesh_fingerprint(h, ob, frame_mesh(scene, ob, motion), prim)
+        else:
+            mesh = create_mesh(scene, ob)
+            mesh_fingerprint(h, ob, mesh, prim)
+            bpy.data.meshes.remove(mesh)
+    elif prim == 'CURVE':
+        rna_fingerprint(h, ob.data)
+    
+    if ob.data and hasattr(ob.data, 'materials'):
+        for mat in ob.data.materials:
+            if mat != None:
+                material_fingerprint(h, mat)
+    
+    return h.hexdigest()
+
+
 
 
 
@@ -593,13 +853,13 @@ def export_light(rpass, scene, file, ob):
     
     params = []
     
-    file.write('    AttributeBegin\n')
-    file.write('    TransformBegin\n')
-    file.write('            Transform %s\n' % rib(m))
+    file.begin('Attribute')
+    file.begin('Transform')
+    file.request('Transform', m)
     
     
     if rm.emit_photons and lamp.type in ('SPOT', 'POINT', 'SUN'):
-        file.write('        Attribute "light" "string emitphotons" [ "on" ]\n' )
+        file.request('Attribute', 'light', 'string emitphotons', ['on'])
 	
 	# BBM addition begin
 	# export light coshaders
@@ -661,16 +921,17 @@ def export_light(rpass, scene, file, ob):
     for sp in params:
         # special exceptions since they're not an actual properties on lamp datablock
         if sp.name == 'from':
-            value = rib(loc)
+            value = loc
         elif sp.name == 'to': 
-            value = rib(lvec)
+            value = lvec
 
 
         elif sp.meta == 'shadow_map_path':
             if shader_requires_shadowmap(scene, rm, 'light'):
+                rpass.dependencies.add(shadowmap_path(scene, ob))
                 path = rib_path(shadowmap_path(scene, ob))
-                print(path)
-                file.write('        "string %s" "%s" \n' % (sp.name, path))
+                file.param('string %s' % sp.name, path)
+            continue
 
             ''' XXX old shaders
 
@@ -693,24 +954,24 @@ def export_light(rpass, scene, file, ob):
             '''
         # more exceptions, use blender's built in equivalent parameters (eg. spot size)
         elif sp.name in exclude_lamp_params.keys():
-            value = rib(getattr(lamp, exclude_lamp_params[sp.name]))
+            value = getattr(lamp, exclude_lamp_params[sp.name])
         
         # otherwise use the stored raw shader parameters
         else:
-            value = rib(sp.value)
+            value = sp.value
 
 		# BBM addition begin
         if sp.is_array:
-            file.write('        "%s %s[%d]" %s\n' % (sp.data_type, sp.name, len(sp.value), rib(sp.value,is_cosh_array=True)))
+            file.param('%s %s[%d]' % (sp.data_type, sp.name, len(sp.value)), sp.value)
         else:
 		# BBM addition end
-            file.write('        "%s %s" %s\n' % (sp.data_type, sp.name, value))
+            file.param('%s %s' % (sp.data_type, sp.name), value)
 
-    file.write('    TransformEnd\n')
-    file.write('    AttributeEnd\n')
+    file.end('Transform')
+    file.end('Attribute')
     
-    file.write('    Illuminate "%s" %d \n' % (ob.name, rm.illuminates_by_default))
-    file.write('    \n')
+    file.request('Illuminate', ob.name, int(rm.illuminates_by_default))
+    file.newline()
 
 def export_sss_bake(file, rpass, mat):
     rm = mat.renderman
@@ -719,17 +980,17 @@ def export_sss_bake(file, rpass, mat):
     
     group = mat.name if rm.sss_group == "" else rm.sss_group
     
-    file.write('        \n')
-    file.write('        Attribute "visibility" "string subsurface" "%s" \n\n' % group)
+    file.newline()
+    file.request('Attribute', 'visibility', 'string subsurface', group)
     
-    file.write('        Attribute "subsurface" \n')
-    file.write('            "color meanfreepath" %s \n' % rib(rm.sss_meanfreepath))
+    file.request('Attribute', 'subsurface')
+    file.param('color meanfreepath', rm.sss_meanfreepath)
     if rm.sss_use_reflectance:
-        file.write('            "color reflectance" %s \n' % rib(rm.sss_reflectance))
-    file.write('            "refractionindex" %s \n' % rm.sss_ior)
-    file.write('            "shadingrate" %s \n' % rm.sss_shadingrate)
-    file.write('            "scale" %s \n' % rm.sss_scale)
-    file.write('        \n')
+        file.param('color reflectance', rm.sss_reflectance)
+    file.param('refractionindex', rm.sss_ior)
+    file.param('shadingrate', rm.sss_shadingrate)
+    file.param('scale', rm.sss_scale)
+    file.newline()
     
 def export_material(file, rpass, scene, mat):
 
@@ -740,11 +1001,11 @@ def export_material(file, rpass, scene, mat):
     rm = mat.renderman
 
     if rm.nodetree != '':
-        file.write('        Color %s\n' % rib(mat.diffuse_color))
-        file.write('        Opacity %s\n' % rib([mat.alpha for i in range(3)]))
+        file.request('Color', mat.diffuse_color)
+        file.request('Opacity', [mat.alpha for i in range(3)])
             
         if rm.displacementbound > 0.0:
-            file.write('        Attribute "displacementbound" "sphere" %f \n' % rm.displacementbound)
+            file.request('Attribute', 'displacementbound', 'sphere', rm.displacementbound)
         
         export_shader_nodetree(file, scene, mat)
     else:
@@ -782,32 +1043,34 @@ def export_strands(file, rpass, scene, ob, motion):
         motion_blur = pname in motion['deformation']
             
         if motion_blur:
-            file.write('        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
+            file.begin('Motion', get_ob_subframes(scene, ob, motion))
             samples = motion['deformation'][pname]
         else:
-            samples = [get_strands(ob, psys)]
+            samples = [frame_strands(ob, psys, motion)]
         
         for nverts, P in samples:
         
-            file.write('    Basis "catmull-rom" 1 "catmull-rom" 1\n')
-            file.write('    Curves "cubic" \n')
-            file.write('        %s \n' % rib(nverts))
-            file.write('        "nonperiodic" \n')
-            file.write('        "P" %s \n' % rib(P))
-            file.write('        "constantwidth" [ %f ] \n' % rm.width)
+            file.request('Basis', 'catmull-rom', 1, 'catmull-rom', 1)
+            file.request('Curves', 'cubic')
+            file.array(nverts)
+            file.arguments('nonperiodic')
+            file.param_array('P', P)
+            file.param('constantwidth', [rm.width])
 
         if motion_blur:
-            file.write('        MotionEnd\n')
+            file.end('Motion')
 
-def geometry_source_rib(scene, ob):
+def export_geometry_source(file, rpass, scene, ob, motion=None):
     rm = ob.renderman
     anim = rm.archive_anim_settings
     blender_frame = scene.frame_current
-    rib = ""
+    
+    if rm.geometry_source in ('ARCHIVE', 'DELAYED_LOAD_ARCHIVE'):
+        record_archive_read(rpass, bpy.path.abspath(get_sequence_path(rm.path_archive, blender_frame, anim)))
     
     if rm.geometry_source == 'ARCHIVE':
         archive_path = rib_path(get_sequence_path(rm.path_archive, blender_frame, anim))
-        rib = '        ReadArchive "%s"\n' % archive_path
+        file.request('ReadArchive', archive_path)
         
     else:
         if rm.procedural_bounds == 'MANUAL':
@@ -815,24 +1078,19 @@ def geometry_source_rib(scene, ob):
             max = rm.procedural_bounds_max
             bounds = [min[0], max[0], min[1], max[1], min[2], max[2]]
         else:
-            bounds = rib_ob_bounds(ob.bound_box)
+            bounds = procedural_bounds(ob, motion)
         
         if rm.geometry_source == 'DELAYED_LOAD_ARCHIVE':
             archive_path = rib_path(get_sequence_path(rm.path_archive, blender_frame, anim))
-            rib = '        Procedural "DelayedReadArchive" ["%s"] %s\n' \
-                                    % (archive_path, rib(bounds))
+            file.request('Procedural', 'DelayedReadArchive', [archive_path], bounds)
         
         elif rm.geometry_source == 'PROCEDURAL_RUN_PROGRAM':
             path_runprogram = rib_path(rm.path_runprogram)
-            rib = '        Procedural "RunProgram" ["%s" "%s"] %s\n' \
-                                    % (path_runprogram, rm.path_runprogram_args, rib(bounds))
+            file.request('Procedural', 'RunProgram', [path_runprogram, rm.path_runprogram_args], bounds)
         
         elif rm.geometry_source == 'DYNAMIC_LOAD_DSO':
             path_dso = rib_path(rm.path_dso)
-            rib = '        Procedural "DynamicLoad" ["%s" "%s"] %s\n' \
-                                    % (path_dso, rm.path_dso_initial_data, rib(bounds))
-
-    return rib
+            file.request('Procedural', 'DynamicLoad', [path_dso, rm.path_dso_initial_data], bounds)
 
 def export_particle_instances(file, rpass, scene, ob, psys, motion):
     rm = psys.settings.renderman
@@ -845,21 +1103,23 @@ def export_particle_instances(file, rpass, scene, ob, psys, motion):
         return
     
     if instance_ob.renderman.geometry_source == 'BLENDER_SCENE_DATA':
+        record_archive_read(rpass, auto_archive_path(rpass.paths, [instance_ob]))
         archive_path = rib_path(auto_archive_path(rpass.paths, [instance_ob]))
-        instance_geometry_rib = '            ReadArchive "%s"\n' % archive_path
     else:
-        instance_geometry_rib = geometry_source_rib(scene, instance_ob)
+        archive_path = None
     
     motion_blur = pname in motion['deformation']
     cfra = scene.frame_current
+    
+    if motion_blur:
+        samples = motion['deformation'][pname]
+    else:
+        samples = [frame_particles(scene, ob, psys, motion)]
 
     for i in range(len( [ p for p in psys.particles if valid_particle(p, cfra) ] )):
         
         if motion_blur:
-            file.write('        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
-            samples = motion['deformation'][pname]
-        else:
-            samples = [get_particles(scene, ob, psys)]
+            file.begin('Motion', get_ob_subframes(scene, ob, motion))
         
         for P, rot, width in samples:
 
@@ -867,12 +1127,15 @@ def export_particle_instances(file, rpass, scene, ob, psys, motion):
             rot = Quaternion((rot[i*4+0], rot[i*4+1], rot[i*4+2], rot[i*4+3]))
             mtx = Matrix.Translation(loc) * rot.to_matrix().to_4x4() * Matrix.Scale(width[i], 4)
             
-            file.write('                Transform %s \n' % rib(mtx))
+            file.request('Transform', mtx)
         
         if motion_blur:
-            file.write('            MotionEnd\n')
+            file.end('Motion')
 
-        file.write( instance_geometry_rib )
+        if archive_path:
+            file.request('ReadArchive', archive_path)
+        else:
+            export_geometry_source(file, rpass, scene, instance_ob)
         
 
 
@@ -880,28 +1143,38 @@ def export_particle_points(file, scene, ob, psys, motion):
     rm = psys.settings.renderman
     pname = psys_motion_name(ob, psys)
     
-    motion_blur = pname in motion['deformation']
+    dPdtime = None
     
-    if motion_blur:
-        file.write('        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
+    if pname in motion['velocity']:
+        P, rot, width = frame_particles(scene, ob, psys, motion)
+        positions, dPdtime = velocity_motion(scene, motion, pname, P)
+        samples = [(P, rot, width) for P in positions]
+    elif pname in motion['deformation']:
         samples = motion['deformation'][pname]
     else:
-        samples = [get_particles(scene, ob, psys)]
+        samples = [frame_particles(scene, ob, psys, motion)]
+    
+    motion_blur = len(samples) > 1
+    
+    if motion_blur:
+        file.begin('Motion', get_subframes(len(samples) - 1))
     
     for P, rot, width in samples:
         
-        file.write('        Points \n')
-        file.write('            "P" %s \n' % rib(P))
-        file.write('            "uniform string type" [ "%s" ] \n' % rm.particle_type)
+        file.request('Points')
+        file.param_array('P', P)
+        if dPdtime != None:
+            file.param_array('vertex vector dPdtime', dPdtime)
+        file.param('uniform string type', [rm.particle_type])
         if rm.constant_width:
-            file.write('            "constantwidth" [%f] \n' % rm.width)
+            file.param('constantwidth', [rm.width])
         elif rm.export_default_size:
-            file.write('            "varying float width" %s \n' % rib(width))
+            file.param_array('varying float width', width)
 
         export_primvars_particle(file, scene, psys)
 
     if motion_blur:
-        file.write('        MotionEnd\n')
+        file.end('Motion')
 
 def export_particles(file, rpass, scene, ob, motion):
 
@@ -912,8 +1185,8 @@ def export_particles(file, rpass, scene, ob, motion):
         if psys.settings.type != 'EMITTER':
             continue
     
-        file.write('    AttributeBegin\n')
-        file.write('        Attribute "identifier" "name" [ "%s" ]\n' % pname)
+        file.begin('Attribute')
+        file.request('Attribute', 'identifier', 'name', [pname])
         
         # use 'material_id' index to decide which material
         if ob.data.materials:
@@ -928,28 +1201,31 @@ def export_particles(file, rpass, scene, ob, motion):
             export_particle_points(file, scene, ob, psys, motion)
         
         
-        file.write('AttributeEnd\n\n')
+        file.end('Attribute')
+        file.newline()
         
 def export_scene_lights(file, rpass, scene):
     if not rpass.light_shaders: return
 
-    file.write('    ## Lights \n\n')
+    file.comment('# Lights')
+    file.newline()
     
     for ob in [o for o in rpass.objects if o.type == 'LAMP']:
         export_light(rpass, scene, file, ob)
 
-    file.write('    \n')
+    file.newline()
 
 
 def export_shader_init(file, rpass, mat):
     rm = mat.renderman
 
     if rpass.emit_photons:
-        file.write('        Attribute "photon" "string shadingmodel" "%s" \n' % rm.photon_shadingmodel)
+        file.request('Attribute', 'photon', 'string shadingmodel', rm.photon_shadingmodel)
 
 def export_shader(file, scene, rpass, idblock, shader_type):
     rm = idblock.renderman
-    file.write('\n        # %s\n' % shader_type ) # BBM addition
+    file.newline()
+    file.comment(shader_type) # BBM addition
 	
     parameterlist = rna_to_shaderparameters(scene, rm, shader_type)
 
@@ -961,30 +1237,30 @@ def export_shader(file, scene, rpass, idblock, shader_type):
             if sp.is_array:
                 collection = sp.value 
                 for item in collection:
-                    file.write('        Shader "%s" "%s"\n' % (item.value, idblock.name+'_'+sp.name) )
+                    file.request('Shader', item.value, idblock.name+'_'+sp.name)
             else:
-                file.write('        Shader "%s" "%s"\n' % (sp.value, sp.value)) #idblock.name+'_'+sp.name) )
+                file.request('Shader', sp.value, sp.value) #idblock.name+'_'+sp.name)
 
     if shader_type == 'surface':
         mat = idblock
         
         if rm.surface_shaders.active == '' or not rpass.surface_shaders: return
         
-        file.write('        Color %s\n' % rib(mat.diffuse_color))
-        file.write('        Opacity %s\n' % rib([mat.alpha for i in range(3)]))
-        file.write('        Surface "%s" \n' % rm.surface_shaders.active)
+        file.request('Color', mat.diffuse_color)
+        file.request('Opacity', [mat.alpha for i in range(3)])
+        file.request('Surface', rm.surface_shaders.active)
         
     elif shader_type == 'displacement':
         if rm.displacement_shaders.active == '' or not rpass.displacement_shaders: return
         
         if rm.displacementbound > 0.0:
-            file.write('        Attribute "displacementbound" "sphere" %f \n' % rm.displacementbound)
-        file.write('        Displacement "%s" \n' % rm.displacement_shaders.active)
+            file.request('Attribute', 'displacementbound', 'sphere', rm.displacementbound)
+        file.request('Displacement', rm.displacement_shaders.active)
             
     elif shader_type == 'interior':
         if rm.interior_shaders.active == '' or not rpass.interior_shaders: return
         
-        file.write('        Interior "%s" \n' % rm.interior_shaders.active)
+        file.request('Interior', rm.interior_shaders.active)
     
     elif shader_type == 'atmosphere':
 
@@ -993,13 +1269,13 @@ def export_shader(file, scene, rpass, idblock, shader_type):
             # use a relative path to pointcloud_dir to work around windows paths issue -
             # bake3d() doesn't seem to like baking windows absolute paths
             relpath = os.path.relpath( rpass.paths["gi_ptc_bake_path"], start=rpass.paths["export_dir"] )            
-            file.write('        # ptc_file is exported as relative path to export directory \n')
-            file.write('        # to work around a problem with windows absolute paths in bake3d() \n')
-            file.write('        Atmosphere "vol_ptcbake" \n')
-            file.write('            "string ptc_file" "%s" \n' % relpath)
+            file.comment('ptc_file is exported as relative path to export directory')
+            file.comment('to work around a problem with windows absolute paths in bake3d()')
+            file.request('Atmosphere', 'vol_ptcbake')
+            file.param('string ptc_file', relpath)
         
         if rm.atmosphere_shaders.active == '' or not rpass.atmosphere_shaders: return
-        file.write('        Atmosphere "%s" \n' % rm.atmosphere_shaders.active)
+        file.request('Atmosphere', rm.atmosphere_shaders.active)
     
 
     '''
@@ -1030,10 +1306,10 @@ def export_shader(file, scene, rpass, idblock, shader_type):
             continue
 
         if sp.is_array:
-            file.write('            "%s %s[%d]" %s\n' % (sp.data_type, sp.name, len(sp.value), rib(sp.value,is_cosh_array=True)))
+            file.param('%s %s[%d]' % (sp.data_type, sp.name, len(sp.value)), sp.value)
         else:
 		# BBM addition end
-            file.write('            "%s %s" %s\n' % (sp.data_type, sp.name, rib(sp.value)))
+            file.param('%s %s' % (sp.data_type, sp.name), sp.value)
 
     # BBM removed begin
     #if type == 'surface':
@@ -1074,7 +1350,7 @@ def get_curve(curve):
             P.extend( bp.handle_right )
             width.append( bp.radius )
         
-        basis = '"bezier" 3 "bezier" 3'
+        basis = ('bezier', 3, 'bezier', 3)
         if spline.use_cyclic_u:
             period = 'periodic'
             # wrap the initial handle around to the end, to begin on the CV
@@ -1097,7 +1373,7 @@ def export_curve(file, scene, ob, motion):
     motion_blur = ob.name in motion['deformation']
     
     if motion_blur:
-        file.write('        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
+        file.begin('Motion', get_ob_subframes(scene, ob, motion))
         samples = motion['deformation'][ob.name]
     else:
         samples = [get_curve(curve)]
@@ -1105,138 +1381,267 @@ def export_curve(file, scene, ob, motion):
     for spline_samples in samples:
         for P, width, npt, basis, period in spline_samples:
 
-            file.write('        Basis %s\n' % basis)
-            file.write('        Curves "cubic" \n')
-            file.write('            [ %s ] \n' % rib(npt))
-            file.write('            "%s" \n' % period)
-            file.write('            "P" %s \n' % rib(P))
-            file.write('            "width" %s \n' % rib(width))
+            file.request('Basis', *basis)
+            file.request('Curves', 'cubic')
+            file.arguments([npt])
+            file.arguments(period)
+            file.param_array('P', P)
+            file.param_array('width', width)
             #file.write('        "constantwidth" [ %f ] \n' % 0.2)
             
     if motion_blur:
-        file.write('        MotionEnd\n')
+        file.end('Motion')
 
 def export_subdivision_mesh(file, scene, ob, motion):
-    mesh = create_mesh(scene, ob)
+    mesh = frame_mesh(scene, ob, motion)
     
-    motion_blur = ob.name in motion['deformation']
+    subsurf = subd_modifier(ob)
+    
+    scheme = 'catmull-clark'
+    if subsurf != None and subsurf.subdivision_type == 'SIMPLE':
+        scheme = 'bilinear'
+    
+    nverts, verts, P = get_mesh(mesh)
+    samples, sample_normals, dPdtime = mesh_motion_samples(scene, ob, P, motion)
+    
+    motion_blur = len(samples) > 1
     
     if motion_blur:
-        file.write('        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
-        samples = motion['deformation'][ob.name]
-    else:
-        samples = [get_mesh(mesh)]
+        file.begin('Motion', get_subframes(len(samples) - 1))
     
     creases = get_subd_creases(mesh)
     
-    for nverts, verts, P in samples:
-        tags = []
-        nargs = []
-        intargs = []
-        floatargs = []
-
-        file.write('        SubdivisionMesh "catmull-clark" \n')
-        file.write('            %s\n' % rib(nverts))
-        file.write('            %s\n' % rib(verts))
-        if len(creases) > 0:
-            for c in creases:
-                tags.append( '"crease"' )
-                nargs.extend( [2, 1] )
-                intargs.extend( [c[0], c[1]] )
-                floatargs.append( c[2] )
-
-        tags.append('"interpolateboundary"')
-        nargs.extend( [0, 0] )
-        
-        file.write('            %s %s %s %s \n' % (rib(tags), rib(nargs), rib(intargs), rib(floatargs)) )
-                
-        file.write('            "P" %s\n' % rib(P))
-        export_primvars(file, ob, mesh, "facevertex")
-        
+    tags = []
+    nargs = []
+    intargs = []
+    floatargs = []
+    
+    if len(creases) > 0:
+        for c in creases:
+            tags.append( 'crease' )
+            nargs.extend( [2, 1] )
+            intargs.extend( [c[0], c[1]] )
+            floatargs.append( c[2] )
+
+    tags.append('interpolateboundary')
+    nargs.extend( [0, 0] )
+    
+    # boundary interpolation of UVs, like blender's 'subdivide UVs' option
+    if subsurf != None:
+        tags.append('facevaryinginterpolateboundary')
+        nargs.extend( [1, 0] )
+        intargs.append( 1 if subsurf.use_subsurf_uv else 0 )
+    
+    # topology and primvars are the same for every sample, so only format them once
+    topology = file.recorder()
+    topology.array(nverts)
+    topology.array(verts)
+    topology.arguments(tags, nargs, intargs, floatargs)
+    
+    primvars = file.recorder()
+    export_primvars(primvars, ob, mesh, "facevertex", normals=not sample_normals)
+    
+    for P, N in samples:
+        file.request('SubdivisionMesh', scheme)
+        file.replay(topology)
+        file.param_array('P', P)
+        if sample_normals:
+            file.param_array('varying normal N', N)
+        if dPdtime != None:
+            file.param_array('vertex vector dPdtime', dPdtime)
+        file.replay(primvars)
 
     if motion_blur:
-        file.write('        MotionEnd\n')
+        file.end('Motion')
             
-    bpy.data.meshes.remove(mesh)
+    release_mesh(motion, ob)
 
 def export_polygon_mesh(file, scene, ob, motion):
-    mesh = create_mesh(scene, ob)
+    mesh = frame_mesh(scene, ob, motion)
     
-    motion_blur = ob.name in motion['deformation']
+    nverts, verts, P = get_mesh(mesh)
+    samples, sample_normals, dPdtime = mesh_motion_samples(scene, ob, P, motion)
+    
+    motion_blur = len(samples) > 1
     
     if motion_blur:
-        file.write('        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
-        samples = motion['deformation'][ob.name]
-    else:
-        samples = [get_mesh(mesh)]
+        file.begin('Motion', get_subframes(len(samples) - 1))
+    
+    # topology and primvars are the same for every sample, so only format them once
+    topology = file.recorder()
+    topology.array(nverts)
+    topology.array(verts)
+    
+    primvars = file.recorder()
+    export_primvars(primvars, ob, mesh, "facevarying", normals=not sample_normals)
         
-    for nverts, verts, P in samples:
+    for P, N in samples:
 
-        file.write('        PointsPolygons \n')
-        file.write('            %s\n' % rib(nverts))
-        file.write('            %s\n' % rib(verts))
-        file.write('            "P" %s\n' % rib(P))
-        export_primvars(file, ob, mesh, "facevarying")
+        file.request('PointsPolygons')
+        file.replay(topology)
+        file.param_array('P', P)
+        if sample_normals:
+            file.param_array('varying normal N', N)
+        if dPdtime != None:
+            file.param_array('vertex vector dPdtime', dPdtime)
+        file.replay(primvars)
         
     if motion_blur:
-        file.write('        MotionEnd\n')
+        file.end('Motion')
             
-    bpy.data.meshes.remove(mesh)
+    release_mesh(motion, ob)
+
+# Level of detail
+#
+# Heavy polygon meshes are written at full resolution and as a series of
+# decimated variants, each under a DetailRange for the renderer to choose
+# from by the size of the object's bounds on screen. Every level is cached
+# on disk by the fingerprint of the evaluated mesh, so unchanged meshes are
+# only decimated once.
+
+# overlap between neighbouring levels, as a factor of the raster area they switch at
+LOD_TRANSITION = 1.25
+
+def open_lod_cache(scene, paths):
+    return FragmentCache(os.path.join(paths['export_dir'], 'lod_cache'),
+                        extension=paths['rib_extension'])
+
+def lod_object(scene, ob, motion):
+    rm = scene.renderman
+    if not rm.lod or ob.type != 'MESH' or detect_primitive(ob) != 'POLYGON_MESH':
+        return False
+    # decimated variants can't share topology between motion samples
+    if ob.name in motion['deformation'] or ob.name in motion['velocity']:
+        return False
+    return bounded(ob) and len(ob.data.vertices) >= rm.lod_vertices
+
+# levels are written as polygons, so the whole stack is evaluated before the
+# decimation, on a copy of the object
+def create_decimated_mesh(scene, ob, ratio):
+    def add_decimate(modifiers):
+        mod = modifiers.new('LOD', 'DECIMATE')
+        mod.ratio = ratio
+    return create_mesh_with(scene, ob, add_decimate)
+
+# DetailRange for each level, from full detail down, in raster pixel area
+def lod_ranges(scene):
+    rm = scene.renderman
+    inf = 1e38
+    
+    # each level switches to the next where its faces would cover as many
+    # pixels as the full detail mesh's do at lod_size
+    areas = [rm.lod_size**2 * rm.lod_ratio**level for level in range(rm.lod_levels)]
+    edges = [(a / LOD_TRANSITION, a * LOD_TRANSITION) for a in areas]
+    
+    upper = [(inf, inf)] + edges
+    lower = edges + [(0.0, 0.0)]
+    return [lo + hi for lo, hi in zip(lower, upper)]
+
+def write_lod_level(scene, ob, mesh, path):
+    archive = open_scene_rib(scene, path)
+    
+    nverts, verts, P = get_mesh(mesh)
+    archive.request('PointsPolygons')
+    archive.array(nverts)
+    archive.array(verts)
+    archive.param_array('P', P)
+    export_primvars(archive, ob, mesh, "facevarying")
+    
+    archive.close()
+
+def export_lod_mesh(file, rpass, scene, ob, motion):
+    rm = scene.renderman
+    if rpass.lod_cache is None:
+        rpass.lod_cache = open_lod_cache(scene, rpass.paths)
+    cache = rpass.lod_cache
+    
+    mesh = frame_mesh(scene, ob, motion)
+    h = hashlib.sha1()
+    h.update(repr((addon_version, rm.rib_format, rm.rib_float_precision)).encode())
+    rna_fingerprint(h, ob.data.renderman)
+    mesh_fingerprint(h, ob, mesh, 'POLYGON_MESH')
+    mesh_hash = h.hexdigest()
+    
+    file.begin('Attribute')
+    file.request('Detail', procedural_bounds(ob, motion))
+    
+    for level, detail_range in enumerate(lod_ranges(scene)):
+        ratio = rm.lod_ratio ** level
+        fingerprint = '%s_%.4f' % (mesh_hash, ratio)
+        
+        if not cache.lookup(fingerprint):
+            if level == 0:
+                write_lod_level(scene, ob, mesh, cache.path(fingerprint))
+            else:
+                decimated = create_decimated_mesh(scene, ob, ratio)
+                write_lod_level(scene, ob, decimated, cache.path(fingerprint))
+                bpy.data.meshes.remove(decimated)
+            cache.add(fingerprint, ob.name)
+        
+        file.request('DetailRange', *detail_range)
+        file.request('ReadArchive', rib_path(cache.path(fingerprint)))
+        record_archive_read(rpass, cache.path(fingerprint), fingerprint)
+    
+    file.end('Attribute')
+    release_mesh(motion, ob)
 
 def export_points(file, scene, ob, motion):
     rm = ob.renderman
     
-    mesh = create_mesh(scene, ob)
+    mesh = frame_mesh(scene, ob, motion)
     
-    motion_blur = ob.name in motion['deformation']
+    nverts, verts, P = get_mesh(mesh)
+    samples, sample_normals, dPdtime = mesh_motion_samples(scene, ob, P, motion)
+    
+    motion_blur = len(samples) > 1
     
     if motion_blur:
-        file.write('        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
-        samples = motion['deformation'][ob.name]
-    else:
-        samples = [get_mesh(mesh)]
+        file.begin('Motion', get_subframes(len(samples) - 1))
         
-    for nverts, verts, P in samples:
+    for P, N in samples:
 
-        file.write('        Points \n')
-        file.write('            "P" %s\n' % rib(P))
-        file.write('            "uniform string type" [ "%s" ] \n' % rm.primitive_point_type)
-        file.write('            "constantwidth" [ %f ] \n' % rm.primitive_point_width)
+        file.request('Points')
+        file.param_array('P', P)
+        if dPdtime != None:
+            file.param_array('vertex vector dPdtime', dPdtime)
+        file.param('uniform string type', [rm.primitive_point_type])
+        file.param('constantwidth', [rm.primitive_point_width])
             
     if motion_blur:
-        file.write('        MotionEnd\n')
+        file.end('Motion')
             
-    bpy.data.meshes.remove(mesh)
+    release_mesh(motion, ob)
 
 
 def export_sphere(file, scene, ob, motion):
     rm = ob.renderman
-    file.write('        Sphere %f %f %f %f \n' %
-        (rm.primitive_radius, rm.primitive_zmin, rm.primitive_zmax, rm.primitive_sweepangle))
+    file.request('Sphere', rm.primitive_radius, rm.primitive_zmin, rm.primitive_zmax, rm.primitive_sweepangle)
         
 def export_cylinder(file, scene, ob, motion):
     rm = ob.renderman
-    file.write('        Cylinder %f %f %f %f \n' %
-        (rm.primitive_radius, rm.primitive_zmin, rm.primitive_zmax, rm.primitive_sweepangle))
+    file.request('Cylinder', rm.primitive_radius, rm.primitive_zmin, rm.primitive_zmax, rm.primitive_sweepangle)
         
 def export_cone(file, scene, ob, motion):
     rm = ob.renderman
-    file.write('        Cone %f %f %f \n' %
-        (rm.primitive_height, rm.primitive_radius, rm.primitive_sweepangle))
+    file.request('Cone', rm.primitive_height, rm.primitive_radius, rm.primitive_sweepangle)
 
 def export_disk(file, scene, ob, motion):
     rm = ob.renderman
-    file.write('        Disk %f %f %f \n' %
-        (rm.primitive_height, rm.primitive_radius, rm.primitive_sweepangle))
+    file.request('Disk', rm.primitive_height, rm.primitive_radius, rm.primitive_sweepangle)
 
 def export_torus(file, scene, ob, motion):
     rm = ob.renderman
-    file.write('        Torus %f %f %f %f %f \n' %
-        (rm.primitive_majorradius, rm.primitive_minorradius, rm.primitive_phimin, rm.primitive_phimax, rm.primitive_sweepangle))
+    file.request('Torus', rm.primitive_majorradius, rm.primitive_minorradius, rm.primitive_phimin, rm.primitive_phimax, rm.primitive_sweepangle)
 
 def is_dupli(ob):
     return ob.type == 'EMPTY' and ob.dupli_type != 'NONE'
 
+def export_object_material(file, rpass, scene, ob):
+    if ob.data and ob.data.materials:
+        for mat in [mat for mat in ob.data.materials if mat != None]:
+            export_material(file, rpass, scene, mat)
+            break
+
 def export_geometry_data(file, rpass, scene, ob, motion, force_prim=''):
 
     # handle duplis
@@ -1260,10 +1665,7 @@ def export_geometry_data(file, rpass, scene, ob, motion, force_prim=''):
     if prim == 'NONE':
         return
 
-    if ob.data and ob.data.materials:
-        for mat in [mat for mat in ob.data.materials if mat != None]:
-            export_material(file, rpass, scene, mat)
-            break
+    export_object_material(file, rpass, scene, ob)
     
     if prim == 'SPHERE':
         export_sphere(file, scene, ob, motion)
@@ -1282,7 +1684,10 @@ def export_geometry_data(file, rpass, scene, ob, motion, force_prim=''):
         
     # mesh only
     elif prim == 'POLYGON_MESH':
-        export_polygon_mesh(file, scene, ob, motion)
+        if lod_object(scene, ob, motion):
+            export_lod_mesh(file, rpass, scene, ob, motion)
+        else:
+            export_polygon_mesh(file, scene, ob, motion)
     elif prim == 'SUBDIVISION_MESH':
         export_subdivision_mesh(file, scene, ob, motion)
     elif prim == 'POINTS':
@@ -1295,114 +1700,449 @@ def export_geometry(file, rpass, scene, ob, motion):
         if ob in rpass.archives:
             archive_path = rib_path(auto_archive_path(rpass.paths, [ob]))        
             if os.path.exists(archive_path):
-                file.write('        ReadArchive "%s"\n' % archive_path)
+                file.request('ReadArchive', archive_path)
+                record_archive_read(rpass, auto_archive_path(rpass.paths, [ob]))
+        elif ob.name in rpass.instances:
+            export_object_material(file, rpass, scene, ob)
+            file.request('ObjectInstance', rpass.instances[ob.name])
+        elif delayed_archive(scene, ob, motion):
+            export_delayed_archive(file, rpass, scene, ob, motion)
         else:
             export_geometry_data(file, rpass, scene, ob, motion)
 
     else:    
-        file.write(geometry_source_rib(scene, ob))
+        export_geometry_source(file, rpass, scene, ob, motion)
 
 
-def export_object(file, rpass, scene, ob, motion):
-    rm = ob.renderman
+# Delayed archives
+#
+# Heavy objects can be written to archives of their own, referenced with a
+# DelayedReadArchive procedural so the renderer only loads them when a bucket
+# reaches their bounds. The procedural is called after the object's transform,
+# so its bounds are in object space, and the renderer blurs them along with
+# any transformation motion.
+
+# each pass type keeps one archive per object, rewritten every export, so the
+# files don't pile up over an animation and renders of unchanged geometry can
+# be skipped by the archive's content digest
+def delayed_archive_path(rpass, ob):
+    archive_dir = os.path.join(rpass.paths['export_dir'], 'delayed')
+    return os.path.join(archive_dir, '%s.%s%s' % (ob.name, rpass.type, rpass.paths['rib_extension']))
+
+# objects with this many vertices or more, counting render subdivision
+def heavy_object(scene, ob):
+    if ob.type != 'MESH':
+        return False
+    
+    nverts = len(ob.data.vertices)
+    for mod in ob.modifiers:
+        if mod.type == 'SUBSURF' and mod.show_render:
+            nverts *= 4 ** mod.render_levels
+    return nverts >= scene.renderman.delayed_archive_vertices
+
+def delayed_archive(scene, ob, motion):
+    if not scene.renderman.delayed_archives:
+        return False
+    # velocity blurred points move outside the bounds of their samples
+    if ob.name in motion['velocity']:
+        return False
+    return bounded(ob) and heavy_object(scene, ob)
+
+# the largest displacement of an object's surface by its displacement shaders
+def displacement_bound(rpass, ob):
+    bound = 0.0
+    
+    if rpass.displacement_shaders and ob.data and hasattr(ob.data, 'materials'):
+        for mat in [mat for mat in ob.data.materials if mat != None]:
+            bound = max(bound, mat.renderman.displacementbound)
+    return bound
 
+# object space RIB bounds around the geometry in every deformation sample
+def procedural_bounds(ob, motion=None, displacement=0.0):
+    corners = [tuple(c) for c in ob.bound_box]
+    
+    if motion != None and ob.name in motion['deformation']:
+        for sample in motion['deformation'][ob.name]:
+            if not isinstance(sample, tuple) or len(sample[0]) == 0:
+                continue
+            P = sample[0]
+            lo = [min(P[i::3]) for i in range(3)]
+            hi = [max(P[i::3]) for i in range(3)]
+            corners.extend(box_corners(lo, hi))
+    
+    bounds = rib_ob_bounds(corners)
+    for i in range(3):
+        bounds[2*i] -= displacement
+        bounds[2*i+1] += displacement
+    return bounds
+
+# object space RIB bounds of the points written for a mesh, in every motion
+# sample. A subdivision surface lies within the hull of its cage.
+def exported_mesh_bounds(scene, ob, motion, displacement=0.0):
+    P = get_mesh(frame_mesh(scene, ob, motion))[2]
+    samples = mesh_motion_samples(scene, ob, P, motion)[0]
+    
+    corners = []
+    for P, N in samples:
+        if len(P) == 0:
+            continue
+        lo = [min(P[i::3]) for i in range(3)]
+        hi = [max(P[i::3]) for i in range(3)]
+        corners.extend(box_corners(lo, hi))
+    if len(corners) == 0:
+        corners = [(0.0, 0.0, 0.0)]
+    
+    bounds = rib_ob_bounds(corners)
+    for i in range(3):
+        bounds[2*i] -= displacement
+        bounds[2*i+1] += displacement
+    return bounds
+
+def export_delayed_archive(file, rpass, scene, ob, motion):
+    path = scene_rib_path(scene, delayed_archive_path(rpass, ob))
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    
+    # before writing the geometry, which releases the frame's mesh
+    bounds = exported_mesh_bounds(scene, ob, motion, displacement_bound(rpass, ob))
+    
+    # written aside and moved into place, since renders of earlier passes
+    # may still be reading the previous archive
+    tmp_path = path + '.tmp'
+    archive = open_scene_rib(scene, tmp_path)
+    archive.digest = hashlib.sha1()
+    export_geometry_data(archive, rpass, scene, ob, motion)
+    archive.close()
+    os.replace(tmp_path, path)
+    
+    file.request('Procedural', 'DelayedReadArchive', [rib_path(path)], bounds)
+    record_archive_read(rpass, path, archive.digest.hexdigest())
+
+# Archives read by the RIB being written, so a render can be skipped only when
+# they're unchanged as well as the RIB itself. 'fingerprint' is a hash of the
+# archive's contents, if known, otherwise its size and modification time are used.
+def record_archive_read(rpass, path, fingerprint=None):
+    rpass.archive_reads[path] = fingerprint
+
+def archive_reads_digest(h, reads):
+    for path in sorted(reads):
+        fingerprint = reads[path]
+        if fingerprint == None:
+            try:
+                st = os.stat(path)
+                fingerprint = '%d %d' % (st.st_size, st.st_mtime_ns)
+            except OSError:
+                fingerprint = 'missing'
+        h.update(repr((path, fingerprint)).encode())
+
+def export_object(file, rpass, scene, ob, motion):
     if ob.type in ('LAMP', 'CAMERA'): return
     
+    cache = rpass.fragment_cache
+    if cache is None or not fragment_cacheable(scene, ob, motion):
+        write_object(file, rpass, scene, ob, motion)
+        return
+    
+    # unchanged objects are read back from the fragment written in an earlier frame
+    fingerprint = object_fingerprint(rpass, scene, ob, motion)
+    if not cache.lookup(fingerprint):
+        # the archives read by the fragment are kept with it, for when it's reused
+        reads = rpass.archive_reads
+        rpass.archive_reads = {}
+        
+        fragment = open_scene_rib(scene, cache.path(fingerprint))
+        write_object(fragment, rpass, scene, ob, motion)
+        fragment.close()
+        cache.add(fingerprint, ob.name, rpass.archive_reads,
+                  fragment.object_stats.get(ob.name, [0, 0]))
+        
+        reads.update(rpass.archive_reads)
+        rpass.archive_reads = reads
+    else:
+        rpass.archive_reads.update(cache.reads(fingerprint))
+    release_mesh(motion, ob)
+    
+    # the fragment's size counts towards the object, for the stats report
+    file.add_object_stats(ob.name, *cache.stats(fingerprint))
+    file.request('ReadArchive', rib_path(cache.path(fingerprint)))
+
+def write_object(file, rpass, scene, ob, motion):
+    rm = ob.renderman
+    
     if ob.parent:
         mat = ob.parent.matrix_world * ob.matrix_local
     else:
         mat = ob.matrix_world
 
-    file.write('    AttributeBegin\n')
-    file.write('        Attribute "identifier" "name" [ "%s" ]\n' % ob.name)
+    file.begin_object(ob.name)
+    file.begin('Attribute')
+    file.request('Attribute', 'identifier', 'name', [ob.name])
 
     # Shading
     if rm.shadingrate_override:
-        file.write('        ShadingRate %f\n' % rm.shadingrate)
-    file.write('        GeometricApproximation "motionfactor"  %d \n' % int(rm.geometric_approx_motion))
-    file.write('        GeometricApproximation "focusfactor"  %d \n' % int(rm.geometric_approx_focus))
+        file.request('ShadingRate', rm.shadingrate)
+    elif adaptive_shading(rpass, scene):
+        file.request('ShadingRate', adaptive_shading_rate(scene, ob, motion))
+    file.request('GeometricApproximation', 'motionfactor', int(rm.geometric_approx_motion))
+    file.request('GeometricApproximation', 'focusfactor', int(rm.geometric_approx_focus))
         
-    file.write('        ShadingInterpolation "%s"\n' % rm.shadinginterpolation)
+    file.request('ShadingInterpolation', rm.shadinginterpolation)
     
-    file.write('        Matte  %d \n' % int(rm.matte))
+    file.request('Matte', int(rm.matte))
     
-    file.write('        Attribute "visibility" \n')
-    file.write('            "integer camera" [ %d ]\n' % int(rm.visibility_camera))
-    file.write('            "integer diffuse" [ %d ]\n' % int(rm.visibility_trace_diffuse))
-    file.write('            "integer specular" [ %d ]\n' % int(rm.visibility_trace_specular))
-    file.write('            "integer photon" [ %d ]\n' % int(rm.visibility_photons))
-    file.write('            "integer transmission" [ %d ]\n' % int(rm.visibility_trace_transmission))
+    file.request('Attribute', 'visibility')
+    file.param('integer camera', [int(rm.visibility_camera)])
+    file.param('integer diffuse', [int(rm.visibility_trace_diffuse)])
+    file.param('integer specular', [int(rm.visibility_trace_specular)])
+    file.param('integer photon', [int(rm.visibility_photons)])
+    file.param('integer transmission', [int(rm.visibility_trace_transmission)])
     
-    file.write('        Attribute "shade" "string diffusehitmode" [ "%s" ] \n' % rm.trace_diffuse_hitmode)
-    file.write('        Attribute "shade" "string specularhitmode" [ "%s" ] \n' % rm.trace_specular_hitmode)
-    file.write('        Attribute "shade" "string transmissionhitmode" [ "%s" ] \n' % rm.trace_transmission_hitmode)
+    file.request('Attribute', 'shade', 'string diffusehitmode', [rm.trace_diffuse_hitmode])
+    file.request('Attribute', 'shade', 'string specularhitmode', [rm.trace_specular_hitmode])
+    file.request('Attribute', 'shade', 'string transmissionhitmode', [rm.trace_transmission_hitmode])
     
-    file.write('        Attribute "trace" "displacements" [ %d ] \n' % int(rm.trace_displacements))
-    file.write('        Attribute "trace" "samplemotion" [ %d ] \n' % int(rm.trace_samplemotion))
+    file.request('Attribute', 'trace', 'displacements', [int(rm.trace_displacements)])
+    file.request('Attribute', 'trace', 'samplemotion', [int(rm.trace_samplemotion)])
 
     if rm.export_coordsys:
-        file.write('        CoordinateSystem "%s" \n' % ob.name)
+        file.request('CoordinateSystem', ob.name)
     
 	# Light Linking
     if rpass.light_shaders:
-        file.write('\n        # Light Linking\n')
+        file.newline()
+        file.comment('Light Linking')
         for light in rm.light_linking:
             light_name = light.light
             if is_renderable(scene, scene.objects[light_name]):
                 if light.illuminate.split(' ')[-1] == 'ON':
-                    file.write('        Illuminate "%s" 1 \n' % light_name)
+                    file.request('Illuminate', light_name, 1)
                 elif light.illuminate.split(' ')[-1] == 'OFF':
-                    file.write('        Illuminate "%s" 0 \n' % light_name)
+                    file.request('Illuminate', light_name, 0)
 
     # Trace Sets
-    file.write('\n        # Trace Sets\n')
+    file.newline()
+    file.comment('Trace Sets')
     for set in rm.trace_set:
         set_name = set.group
         set_mode = '+'
         if set.mode.startswith('exclude'):
             set_mode = '-'
-        file.write('        Attribute "grouping" "string membership" ["%s%s"] \n' % (set_mode,set_name))
+        file.request('Attribute', 'grouping', 'string membership', [set_mode + set_name])
 	
     # Transformation
     if ob.name in motion['transformation']:
-        file.write('\n        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
+        file.newline()
+        file.begin('Motion', get_ob_subframes(scene, ob, motion))
         
         for sample in motion['transformation'][ob.name]:
-            file.write('            Transform %s\n' % rib(sample))
+            file.request('Transform', sample)
             
-        file.write('        MotionEnd\n')
+        file.end('Motion')
     else:
-        file.write('        Transform %s\n' % rib(mat))
+        file.request('Transform', mat)
 
     export_geometry(file, rpass, scene, ob, motion)
     export_strands(file, rpass, scene, ob, motion)
     
-    file.write('    AttributeEnd\n\n')
+    file.end('Attribute')
+    file.newline()
     
     # Particles live in worldspace, export as separate object
     export_particles(file, rpass, scene, ob, motion)
+    file.end_object()
 
-def empty_motion():
+def empty_motion(budget=0, directory=None, frame=None):
     motion = {}
-    motion['transformation'] = {}
-    motion['deformation'] = {}
+    motion['transformation'] = MotionStore()
+    motion['deformation'] = MotionStore(budget, directory)
+    motion['topology'] = {}
+    motion['inconsistent'] = set()
+    motion['frame'] = frame if frame != None else empty_frame()
+    
+    # time -> {object name: [(store, name) of each sample taken for the object]}
+    motion['evaluated'] = {}
+    motion['scene'] = ''
+    
+    # object name -> number of motion segments, when chosen adaptively
+    motion['segments'] = {}
+    
+    # name -> displacement over a frame, for velocity blurred particles and fluids
+    motion['velocity'] = {}
     return motion
 
-def export_motion_ob(scene, motion, ob):
+# Deformation samples of meshes only keep the points (and normals, if they're
+# exported). The topology is kept once per object, and checked against each sample.
+def add_mesh_sample(motion, name, time, mesh_data, N=None):
+    nverts, verts, P = mesh_data
+    
+    check_topology(motion, name, nverts, verts)
+    motion['deformation'].add(name, time, (P, N))
+
+def check_topology(motion, name, nverts, verts):
+    topology = motion['topology'].get(name)
+    if topology is None:
+        motion['topology'][name] = (nverts, verts)
+    elif topology[0] != nverts or topology[1] != verts:
+        motion['inconsistent'].add(name)
+
+# (P, N) for each sample of a mesh, one per subframe, with P from the current frame
+# if it isn't deformation blurred. Also returns whether the normals need writing
+# per sample, otherwise they're the same for all samples and written with the
+# other primvars, and the dPdtime primvar for velocity blur, or None.
+def mesh_motion_samples(scene, ob, P, motion):
+    if ob.name in motion['velocity']:
+        positions, dPdtime = velocity_motion(scene, motion, ob.name, P)
+        return [(P, None) for P in positions], False, dPdtime
+    
+    samples = motion['deformation'].get(ob.name)
+    if samples is None:
+        return [(P, None)], False, None
+    
+    N0 = samples[0][1]
+    sample_normals = N0 is not None and any(N != N0 for P, N in samples)
+    return samples, sample_normals, None
+
+# Velocity blur
+#
+# Particles and fluids can be motion blurred from their velocity rather than
+# sampling positions at each subframe. Either a single sample is written with
+# a dPdtime primvar, or two samples extrapolated over the shutter.
+
+def velocity_blurred(scene, psys=None):
+    if scene.renderman.velocity_blur == 'NONE':
+        return False
+    # instanced objects also need rotation and size from each sample
+    return psys == None or psys.settings.renderman.particle_type != 'OBJECT'
+
+# positions to write, and the dPdtime primvar or None
+def velocity_motion(scene, motion, name, P):
+    V = motion['velocity'][name]
+    
+    if scene.renderman.velocity_blur == 'PRIMVAR':
+        return [P], V
+    else:
+        return [P, array('f', map(operator.add, P, V))], None
+
+def close_motion(motion):
+    motion['transformation'].close()
+    motion['deformation'].close()
+    
+    if not motion['frame']['shared']:
+        close_frame(motion['frame'])
+
+# Current-frame geometry, passed around in motion['frame'] along with the samples.
+# When it's shared between several passes, meshes, particles and hair are kept
+# until the whole frame is written, otherwise meshes are freed as soon as the
+# object using them is written.
+def empty_frame(shared=False):
+    frame = {}
+    frame['shared'] = shared
+    frame['meshes'] = {}
+    frame['particles'] = {}
+    frame['strands'] = {}
+    return frame
+
+def close_frame(frame):
+    for mesh in frame['meshes'].values():
+        bpy.data.meshes.remove(mesh)
+    frame['meshes'] = {}
+    frame['particles'] = {}
+    frame['strands'] = {}
+
+def frame_mesh(scene, ob, motion):
+    meshes = motion['frame']['meshes']
+    if ob.name not in meshes:
+        meshes[ob.name] = create_mesh(scene, ob)
+    return meshes[ob.name]
+
+def release_mesh(motion, ob):
+    frame = motion['frame']
+    if frame['shared']:
+        return
+    
+    mesh = frame['meshes'].pop(ob.name, None)
+    if mesh != None:
+        bpy.data.meshes.remove(mesh)
+
+def frame_particles(scene, ob, psys, motion):
+    frame = motion['frame']
+    if not frame['shared']:
+        return get_particles(scene, ob, psys)
+    
+    pname = psys_motion_name(ob, psys)
+    if pname not in frame['particles']:
+        frame['particles'][pname] = get_particles(scene, ob, psys)
+    return frame['particles'][pname]
+
+def frame_strands(ob, psys, motion):
+    frame = motion['frame']
+    if not frame['shared']:
+        return get_strands(ob, psys)
+    
+    pname = psys_motion_name(ob, psys)
+    if pname not in frame['strands']:
+        frame['strands'][pname] = get_strands(ob, psys)
+    return frame['strands'][pname]
+
+# Scene evaluation for one frame, shared by the point cloud, shadow map and
+# beauty passes. Motion samples are collected once for every renderable object,
+# and current-frame geometry is shared when more than one pass is rendered.
+class FrameEvaluation:
+    def __init__(self, rpass, scene, passes=1, previous=None):
+        self.frame = empty_frame(shared=passes > 1)
+        
+        # shadow maps are always motion blurred
+        shadows = any(shadowmap_generate_required(scene, ob) for ob in rpass.objects)
+        
+        mrpass = RPass(scene, rpass.objects, rpass.paths)
+        mrpass.motion_blur = rpass.motion_blur or shadows
+        
+        self.motion = export_motion(mrpass, scene, self.frame, previous)
+        self.static = empty_motion(frame=self.frame)
+        
+        # shared by all the passes, see open_pass_caches()
+        self.fragment_cache = open_fragment_cache(scene, rpass.paths)
+        self.lod_cache = open_lod_cache(scene, rpass.paths) if scene.renderman.lod else None
+        
+        # export_motion() already finishes on the current frame
+        if not mrpass.motion_blur:
+            scene.frame_set(scene.frame_current)
+    
+    def motion_for(self, rpass):
+        return self.motion if rpass.motion_blur else self.static
+    
+    def close(self, keep_motion=False):
+        save_cache(self.lod_cache)
+        save_cache(self.fragment_cache)
+        
+        if not keep_motion:
+            close_motion(self.motion)
+        close_motion(self.static)
+        close_frame(self.frame)
+
+# Motion samples of the last frame of an animation render, for the next frame to reuse
+motion_window = None
+
+def slide_motion_window(motion):
+    global motion_window
+    
+    if motion_window != None and motion_window is not motion:
+        close_motion(motion_window)
+    motion_window = motion
+
+def export_motion_ob(scene, motion, ob, time, samples):
 
     prim = detect_primitive(ob)
 
     # object transformation animation
     if ob.animation_data != None or ob.constraints:
-        if ob.name not in motion['transformation'].keys():
-            motion['transformation'][ob.name] = []
-        
         if ob.parent:
             mat = ob.parent.matrix_world * ob.matrix_local
         else:
             mat = ob.matrix_world
         
-        motion['transformation'][ob.name].insert(0, mat.copy())
+        motion['transformation'].add(ob.name, time, mat.copy())
+        samples.append(('transformation', ob.name))
 
     # recursive dupli sub-objects
     if is_dupli(ob):
@@ -1411,89 +2151,688 @@ def export_motion_ob(scene, motion, ob):
         dupobs = [(dob.object, dob.matrix) for dob in ob.dupli_list]
         for dupob, dupob_mat in dupobs:
             if not dupob.hide_render:
-                export_motion_ob(scene, motion, dupob)
+                export_motion_ob(scene, motion, dupob, time, samples)
         ob.dupli_list_clear()
 
     # particles
     for psys in ob.particle_systems:
         pname = psys_motion_name(ob, psys)
         
-        if pname not in motion['deformation'].keys():
-            motion['deformation'][pname] = []
-        
-        if psys.settings.type == 'EMITTER':
-            motion['deformation'][pname].insert(0, get_particles(scene, ob, psys));
+        if psys.settings.type == 'EMITTER' and velocity_blurred(scene, psys=psys):
+            if scene.frame_subframe == 0.0:
+                motion['velocity'][pname] = get_particle_velocity(scene, ob, psys)
+            samples.append(('velocity', pname))
+        elif psys.settings.type == 'EMITTER':
+            motion['deformation'].add(pname, time, get_particles(scene, ob, psys))
+            samples.append(('deformation', pname))
         if psys.settings.type == 'HAIR':
-            motion['deformation'][pname].insert(0, get_strands(ob, psys));
+            motion['deformation'].add(pname, time, get_strands(ob, psys))
+            samples.append(('deformation', pname))
 
     if prim in ('POLYGON_MESH', 'SUBDIVISION_MESH', 'POINTS'):
         # fluid sim deformation - special case
-        if is_deforming_fluid(ob):
-            if ob.name not in motion['deformation'].keys():
-                motion['deformation'][ob.name] = []
-            
-            motion['deformation'][ob.name].insert(0, get_fluid_mesh(scene, ob))          
+        if is_deforming_fluid(ob) and velocity_blurred(scene):
+            if scene.frame_subframe == 0.0:
+                motion['velocity'][ob.name] = get_fluid_velocity(ob)
+            samples.append(('velocity', ob.name))
+        elif is_deforming_fluid(ob):
+            add_mesh_sample(motion, ob.name, time, get_fluid_mesh(scene, ob))
+            samples.append(('fluid', ob.name))
         
         # deformation animation
         if is_deforming(ob):
-            if ob.name not in motion['deformation'].keys():
-                motion['deformation'][ob.name] = []
-            
             mesh = create_mesh(scene, ob)
-            motion['deformation'][ob.name].insert(0, get_mesh(mesh))
+            N = get_mesh_vertex_N(mesh) if exports_normals(ob) else None
+            add_mesh_sample(motion, ob.name, time, get_mesh(mesh), N)
             bpy.data.meshes.remove(mesh)
+            samples.append(('deformation', ob.name))
 
     # not working yet, needs access to post-deform-modifier curve data
     elif prim == 'CURVE':
         if is_deforming(ob):
-            if ob.name not in motion['deformation'].keys():
-                motion['deformation'][ob.name] = []
+            motion['deformation'].add(ob.name, time, get_curve(ob.data))
+            samples.append(('deformation', ob.name))
+
+# Copy the samples of an object at the given time from the motion of the previous
+# frame, if they were taken there. The shutter close of one frame is often the
+# same time as the shutter open of the next, so sequences don't need to take
+# those samples twice.
+def reuse_motion_ob(motion, previous, ob, time):
+    if previous == None or previous['scene'] != motion['scene']:
+        return False
+    
+    samples = previous['evaluated'].get(time, {}).get(ob.name)
+    if samples == None:
+        return False
+    
+    # fluid meshes are extrapolated from the subframe, and velocities are only
+    # taken on the current frame, so neither can be reused
+    if any(kind in ('fluid', 'velocity') for kind, name in samples):
+        return False
+    
+    found = [previous[kind].sample_at(name, time) for kind, name in samples]
+    if None in found:
+        return False
+    
+    for (kind, name), sample in zip(samples, found):
+        motion[kind].add(name, time, sample)
+        
+        if kind == 'deformation' and name in previous['topology']:
+            check_topology(motion, name, *previous['topology'][name])
+    
+    motion['evaluated'].setdefault(time, {})[ob.name] = samples
+    return True
+
+# Adaptive motion segments
+#
+# Moving objects are probed on a grid of subframes, one for each of the scene's
+# motion segments. Each gets the fewest segments (from those that divide the
+# grid evenly) for which a straight line between samples stays within the error
+# tolerance of the probes in between, so slow moving objects get a single
+# segment, while fast spinning ones get as many as needed.
+
+# world space corners of the object's bounds, with deformation
+def motion_probe(ob):
+    mat = ob.matrix_world
+    return [mat * Vector(corner) for corner in ob.bound_box]
+
+# largest distance of the probes from their linear interpolation with 'step' probes per segment
+def motion_probe_error(probes, step):
+    error = 0.0
+    
+    for i in range(len(probes)):
+        k = i - i % step
+        if k == i:
+            continue
+        
+        f = (i - k) / step
+        for p, p0, p1 in zip(probes[i], probes[k], probes[k+step]):
+            error = max(error, (p - p0.lerp(p1, f)).length)
+    
+    return error
+
+# pixels per world space unit at the object's distance from the camera
+def motion_probe_screen_scale(scene, probe):
+    cam = scene.camera
+    if cam == None or cam.type != 'CAMERA':
+        return 1.0
+    
+    xres, yres = render_get_resolution(scene.render)
+    
+    if cam.data.type == 'ORTHO':
+        return max(xres, yres) / cam.data.ortho_scale
+    
+    center = sum(probe, Vector()) / len(probe)
+    depth = -(cam.matrix_world.inverted() * center).z
+    focal = max(xres, yres) * 0.5 / math.tan(cam.data.angle * 0.5)
+    
+    return focal / max(depth, cam.data.clip_start)
+
+# Adaptive shading rate
+#
+# In the beauty pass, objects that are small on screen, or blurred by motion
+# or depth of field, are shaded more coarsely than the scene's shading rate,
+# up to a maximum. Rates are rounded so they don't change with every small
+# camera move, which would keep objects out of the fragment cache.
+
+def adaptive_shading(rpass, scene):
+    return scene.renderman.shadingrate_adaptive and rpass.type == 'default'
+
+# raster position of a world space point, relative to the center of the image
+def camera_raster(scene, cam, view, p):
+    xres, yres = render_get_resolution(scene.render)
+    q = view * p
+    
+    if cam.data.type == 'ORTHO':
+        return q.xy * (max(xres, yres) / cam.data.ortho_scale)
+    
+    focal = max(xres, yres) * 0.5 / math.tan(cam.data.angle * 0.5)
+    return q.xy * (focal / max(-q.z, cam.data.clip_start))
+
+def adaptive_shading_rate(scene, ob, motion=None):
+    rm = scene.renderman
+    cam = scene.camera
+    if cam == None or cam.type != 'CAMERA':
+        return rm.shadingrate
+    
+    probe = motion_probe(ob)
+    scale = motion_probe_screen_scale(scene, probe)
+    
+    # coarser for objects smaller on screen than shadingrate_size
+    size = (probe[6] - probe[0]).length * scale
+    factor = rm.shadingrate_size / max(size, 1.0)
+    
+    # screen space motion of the bounds from shutter open to close
+    blur = 0.0
+    if motion != None:
+        ob_samples = motion['transformation'].get(ob.name) or [ob.matrix_world]
+        cam_samples = motion['transformation'].get(cam.name) or [cam.matrix_world]
+        
+        if len(ob_samples) > 1 or len(cam_samples) > 1:
+            view_open = cam_samples[0].inverted()
+            view_close = cam_samples[-1].inverted()
+            
+            for corner in ob.bound_box:
+                p0 = camera_raster(scene, cam, view_open, ob_samples[0] * Vector(corner))
+                p1 = camera_raster(scene, cam, view_close, ob_samples[-1] * Vector(corner))
+                blur = max(blur, (p1 - p0).length)
+    
+    # circle of confusion, for the focal length of 1 given to DepthOfField
+    if rm.depth_of_field and cam.data.type != 'ORTHO':
+        focus = max(camera_dof_distance(cam), cam.data.clip_start)
+        center = sum(probe, Vector()) / len(probe)
+        depth = max(-(cam.matrix_world.inverted() * center).z, cam.data.clip_start)
+        blur += abs(depth - focus) / (focus * rm.fstop) * scale
+    
+    factor = max(factor, 1.0) * (1.0 + blur / rm.shadingrate_blur)
+    rate = clamp(rm.shadingrate * factor, rm.shadingrate, max(rm.shadingrate, rm.shadingrate_max))
+    return round(rate, 1)
+
+def adaptive_motion_candidate(ob):
+    # particles and duplis move independently of the object's bounds
+    if ob.type in ('CAMERA', 'LAMP') or ob.renderman.motion_segments_override:
+        return False
+    if is_dupli(ob) or len(ob.particle_systems) > 0 or is_deforming_fluid(ob):
+        return False
+    return ob.animation_data != None or ob.constraints or is_deforming(ob)
+
+# returns ({object name: segments}, number of scene updates made). The motion
+# samples of the probed objects are kept in 'probe', for export_motion() to use
+def adaptive_motion_segments(rpass, scene, origframe, probe):
+    rm = scene.renderman
+    
+    grid = rm.motion_segments
+    
+    obs = [ob for ob in rpass.objects if adaptive_motion_candidate(ob)]
+    if grid == 1 or not obs:
+        return {}, 0
+    
+    probes = dict((ob.name, []) for ob in obs)
+    
+    # future to present, finishing on the current frame
+    for i in range(grid, -1, -1):
+        scene.frame_set(origframe, i / grid)
+        time = round(origframe + i / grid, 6)
+        
+        for ob in obs:
+            probes[ob.name].insert(0, motion_probe(ob))
             
-            motion['deformation'][ob.name].insert(0, get_curve(ob.data))
+            # transforms are cheap to keep, deformation is only extracted
+            # later, at the subframes the object ends up using
+            if not is_deforming(ob):
+                samples = []
+                export_motion_ob(scene, probe, ob, time, samples)
+                probe['evaluated'].setdefault(time, {})[ob.name] = samples
+    
+    segments = {}
+    for ob in obs:
+        ob_probes = probes[ob.name]
+        
+        scale = 1.0
+        if rm.motion_error_space == 'SCREEN':
+            scale = motion_probe_screen_scale(scene, ob_probes[0])
+        
+        divisors = [segs for segs in range(1, grid + 1) if grid % segs == 0]
+        for segs in divisors:
+            if segs == grid or motion_probe_error(ob_probes, grid // segs) * scale <= rm.motion_error:
+                break
+        segments[ob.name] = segs
+    
+    return segments, grid + 1
+
+# objects whose only motion is velocity blurred particles or fluid, for which
+# the velocity is read on the current frame, without sampling any subframes
+def velocity_only(scene, ob):
+    if ob.animation_data != None or ob.constraints or is_dupli(ob) or is_deforming(ob):
+        return False
+    if is_deforming_fluid(ob) and not velocity_blurred(scene):
+        return False
+    
+    for psys in ob.particle_systems:
+        if psys.settings.type != 'EMITTER' or not velocity_blurred(scene, psys=psys):
+            return False
+    return is_deforming_fluid(ob) or len(ob.particle_systems) > 0
+
+# Objects to sample at each subframe, from the union of every object's subframes.
+# Subframes are rounded, so the same time from different numbers of
+# motion segments (eg. 0.5 from 2 and 4 segments) only needs one update.
+def motion_schedule(rpass, scene, motion):
+    schedule = {}
+    
+    for ob in rpass.objects:
+        if velocity_only(scene, ob):
+            subframes = [1.0]
+        else:
+            subframes = get_ob_subframes(scene, ob, motion)
+        
+        for sub in subframes:
+            subframe = round(1.0-sub, 6)
+            schedule.setdefault(subframe, []).append(ob)
+    
+    return schedule
 
 # Collect and store motion blur transformation data in a pre-process.
 # More efficient, and avoids too many frame updates in blender.
-def export_motion(rpass, scene):
-    motion = empty_motion()
-    origframe = scene.frame_current
+def export_motion(rpass, scene, frame=None, previous=None, origframe=None):
+    rm = scene.renderman
+    motion = empty_motion(rm.motion_memory*1024*1024, rpass.paths['export_dir'], frame)
+    motion['scene'] = scene.name
+    if origframe == None:
+        origframe = scene.frame_current
     
     if not rpass.motion_blur:
         return motion
 
-    # get a de-duplicated set of all possible numbers of motion segments 
-    # from renderable objects in the scene, and global scene settings
-    all_segs = [ob.renderman.motion_segments for ob in rpass.objects if ob.renderman.motion_segments_override]
-    all_segs.append(scene.renderman.motion_segments)
-    all_segs = set(all_segs)
+    # the aim here is to do only a minimal number of scene updates, so the scene
+    # is updated once for each unique subframe needed by any object, ordered from
+    # future to present (so the loop ends on the current frame/subframe)
+    updates = 0
+    probe = None
+    if rm.motion_segments_adaptive:
+        # probing already evaluates the subframes the probed objects end up
+        # using, so their samples are taken from there rather than again
+        probe = empty_motion(rm.motion_memory*1024*1024, rpass.paths['export_dir'])
+        probe['scene'] = scene.name
+        motion['segments'], updates = adaptive_motion_segments(rpass, scene, origframe, probe)
+    
+    schedule = motion_schedule(rpass, scene, motion)
+    reused = 0
+    
+    for subframe in sorted(schedule.keys(), reverse=True):
+        time = round(origframe + subframe, 6)
+        
+        obs = [ob for ob in schedule[subframe] if not reuse_motion_ob(motion, probe, ob, time)]
+        obs = [ob for ob in obs if not reuse_motion_ob(motion, previous, ob, time)]
+        reused += len(schedule[subframe]) - len(obs)
+        if not obs:
+            continue
+        
+        scene.frame_set(origframe, subframe)
+        updates += 1
+        
+        for ob in obs:
+            samples = []
+            export_motion_ob(scene, motion, ob, time, samples)
+            motion['evaluated'].setdefault(time, {})[ob.name] = samples
+    
+    # always finish on the current frame
+    if scene.frame_current != origframe or scene.frame_subframe != 0.0:
+        scene.frame_set(origframe)
+        updates += 1
+    
+    if probe != None:
+        close_motion(probe)
+    
+    print("Motion blur: %d scene updates for %d objects, %d samples reused from probing or the previous frame" %
+            (updates, len(rpass.objects), reused))
+    
+    # meshes can't be deformation blurred if their topology changes
+    for name in motion['inconsistent']:
+        print("Topology of %s changes during the shutter interval, exporting without deformation blur" % name)
+        del motion['deformation'][name]
+        del motion['topology'][name]
+    motion['inconsistent'].clear()
+    
+    # objects with animation data or deform modifiers often don't actually move,
+    # writing those with motion blocks of identical samples is just wasted work
+    static = 0
+    for store in (motion['transformation'], motion['deformation']):
+        for name in store.keys():
+            if store.is_static(name, rm.motion_tolerance):
+                store.mark_static(name)
+                static += 1
+    if static > 0:
+        print("Motion blur: %d static objects exported without motion blocks" % static)
+    
+    if len(motion['deformation']) > 0:
+        print(motion['deformation'].stats_report())
+                        
+    return motion
+
+
+# Frustum culling
+#
+# Objects are tested with the corners of their bounds at each of their motion
+# samples, so anything passing through the view while the shutter is open is kept.
+
+# world space corners of an object's bounds, over all its motion samples
+def motion_bound_corners(ob, motion):
+    # deformation can move points outside the current frame's bounds
+    bounds = procedural_bounds(ob, motion)
+    corners = box_corners(bounds[0::2], bounds[1::2])
+    
+    if ob.name in motion['transformation']:
+        matrices = motion['transformation'][ob.name]
+    else:
+        matrices = [ob.matrix_world]
+    
+    return [tuple(mat * Vector(c)) for mat in matrices for c in corners]
+
+# objects whose bounds say where all of their geometry is
+def bounded(ob):
+    if ob.renderman.geometry_source != 'BLENDER_SCENE_DATA':
+        return False
+    # particles and duplis are placed independently of the object
+    return not is_dupli(ob) and len(ob.particle_systems) == 0
+
+# objects that can't be seen in the pass other than through its frustums
+def cullable(rpass, ob):
+    if not bounded(ob):
+        return False
+    
+    # objects off camera can still be seen by rays
+    if rpass.type != 'shadowmap':
+        rm = ob.renderman
+        if rm.visibility_trace_diffuse or rm.visibility_trace_specular or \
+                rm.visibility_trace_transmission or rm.visibility_photons:
+            return False
+    return True
+
+def visible_objects(rpass, motion):
+    rpass.culled = []
+    if rpass.frustums == None:
+        return rpass.objects
+    
+    visible = []
+    for ob in rpass.objects:
+        if cullable(rpass, ob) and not any_contains_box(rpass.frustums, motion_bound_corners(ob, motion)):
+            rpass.culled.append(ob)
+        else:
+            visible.append(ob)
+    
+    return visible
+
+# Frustums of the scene camera, one for each of its motion samples, or None.
+# With depth of field, they're widened by the lens aperture, since points
+# just outside the view can be blurred into it.
+def camera_frustums(scene, motion):
+    ob = scene.camera
+    if not ob or ob.type != 'CAMERA':
+        return None
     
-    # the aim here is to do only a minimal number of scene updates, 
-    # so we process objects in batches of equal numbers of segments
-    # and update the scene only once for each of those unique fractional frames per segment set
-    for segs in all_segs:
+    cam = ob.data
+    rm = scene.renderman
+    xaspect, yaspect, aspectratio = render_get_aspect(scene.render, cam)
+    
+    padding = 0.0
+    spread = 0.0
+    if rm.depth_of_field:
+        # aperture radius, for the focal length of 1 given to DepthOfField
+        padding = 0.5 / rm.fstop
+        spread = math.atan(padding / max(camera_dof_distance(ob), cam.clip_start))
+    
+    if ob.name in motion['transformation']:
+        matrices = motion['transformation'][ob.name]
+    else:
+        matrices = [ob.matrix_world]
+    
+    frustums = []
+    for mat in matrices:
+        view = mat.inverted()
+        if cam.type == 'PERSP':
+            sensor = cam.sensor_height if cam.sensor_fit == 'VERTICAL' else cam.sensor_width
+            t = (sensor*0.5)/cam.lens/aspectratio
+            frustums.append(Frustum.perspective(view,
+                    math.atan(t*xaspect) + spread, math.atan(t*yaspect) + spread, padding))
+        else:
+            lens = cam.ortho_scale
+            frustums.append(Frustum.orthographic(view,
+                    xaspect*lens/(aspectratio*2.0), yaspect*lens/(aspectratio*2.0), padding))
+    
+    return frustums
+
+# RIB bytes written for each object in the last beauty pass, for estimating
+# the savings of culling objects that don't get written any more
+object_rib_sizes = {}
+
+# bytes per number in ASCII RIB, roughly
+RIB_VALUE_SIZE = 10
 
-        if segs == scene.renderman.motion_segments:
-            motion_obs = [ob for ob in rpass.objects if not ob.renderman.motion_segments_override]
+def rib_size_estimate(ob):
+    if ob.name in object_rib_sizes:
+        return object_rib_sizes[ob.name]
+    if ob.type != 'MESH':
+        return 0
+    
+    mesh = ob.data
+    return RIB_VALUE_SIZE * (len(mesh.vertices)*3 + len(mesh.loops) + len(mesh.polygons))
+
+def culling_report(rpass):
+    lines = ['Camera culling: %d of %d objects culled, about %.1f KB saved' %
+            (len(rpass.culled), len(rpass.objects), sum(rib_size_estimate(ob) for ob in rpass.culled) / 1024.0)]
+    for ob in rpass.culled:
+        lines.append('    %s: about %.1f KB' % (ob.name, rib_size_estimate(ob) / 1024.0))
+    return '\n'.join(lines)
+
+# Frustums of a lamp's shadow map, one for each of its motion samples,
+# or None if it can't be culled against. Spot lamps use the cone, since
+# only objects in it can cast shadows where the lamp shines.
+def shadowmap_frustums(scene, ob, motion):
+    lamp = ob.data
+    rm = lamp.renderman
+    
+    distant_scale = None
+    if rm.light_shaders.active != '':
+        for sp in rna_to_shaderparameters(scene, rm, 'light'):
+            if sp.meta == 'distant_scale':
+                distant_scale = sp.value
+    
+    if distant_scale == None and lamp.type != 'SPOT':
+        return None
+    
+    if ob.name in motion['transformation']:
+        matrices = motion['transformation'][ob.name]
+    else:
+        matrices = [ob.matrix_world]
+    
+    frustums = []
+    for mat in matrices:
+        view = mat.inverted()
+        if distant_scale != None:
+            frustums.append(Frustum.orthographic(view, distant_scale / 2.0, distant_scale / 2.0))
         else:
-            motion_obs = [ob for ob in rpass.objects if ob.renderman.motion_segments == segs]
+            frustums.append(Frustum.perspective(view, lamp.spot_size / 2.0, lamp.spot_size / 2.0))
+    
+    return frustums
 
-        # prepare list of frames/sub-frames in advance, ordered from future to present,
-        # to prevent too many scene updates (since loop ends on current frame/subframe)
-        for sub in get_subframes(segs):
-            scene.frame_set(origframe, 1.0-sub)
-            
-            for ob in motion_obs:
-                export_motion_ob(scene, motion, ob)
-                        
-    return motion
+# Instancing
+#
+# Meshes shared by several objects, with nothing that could make their
+# geometry differ from one object to the next, are written once between
+# ObjectBegin and ObjectEnd. Each object then places the mesh with
+# ObjectInstance, under its own transform, attributes and material.
+
+# objects with the same key can share a mesh, None if the object can't
+def instance_key(ob, motion):
+    if ob.type != 'MESH' or ob.renderman.geometry_source != 'BLENDER_SCENE_DATA':
+        return None
+    if ob.data.users < 2 or len(ob.modifiers) > 0 or ob.data.shape_keys != None:
+        return None
+    if ob.name in motion['deformation'] or ob.name in motion['velocity']:
+        return None
+    
+    prim = detect_primitive(ob)
+    if prim not in ('POLYGON_MESH', 'SUBDIVISION_MESH'):
+        return None
+    
+    # vertex group primvars are looked up through the object
+    vgroups = tuple(vg.name for vg in ob.vertex_groups)
+    return (ob.data.name, prim, vgroups, ob.vertex_groups.active_index)
+
+def instance_handle(key):
+    return '%s.%s' % (key[0], hashlib.sha1(repr(key).encode()).hexdigest()[:8])
 
+def export_instances(file, rpass, scene, objects, motion):
+    rpass.instances = {}
+    
+    users = {}
+    for ob in objects:
+        key = instance_key(ob, motion)
+        if key != None:
+            users.setdefault(key, []).append(ob)
+    
+    for key in sorted(users.keys()):
+        obs = users[key]
+        if len(obs) < 2:
+            continue
+        
+        handle = instance_handle(key)
+        file.begin('Object', handle)
+        if key[1] == 'SUBDIVISION_MESH':
+            export_subdivision_mesh(file, scene, obs[0], motion)
+        else:
+            export_polygon_mesh(file, scene, obs[0], motion)
+        file.end('Object')
+        file.newline()
+        
+        for ob in obs:
+            rpass.instances[ob.name] = handle
+    
+    if rpass.instances:
+        print('Instancing: %d objects share %d meshes' %
+            (len(rpass.instances), len(set(rpass.instances.values()))))
 
 def export_objects(file, rpass, scene, motion):
 
-    file.write('    ## Objects \n\n')
+    file.comment('# Objects')
+    file.newline()
+
+    objects = visible_objects(rpass, motion)
+    export_instances(file, rpass, scene, objects, motion)
 
     # export the objects to RIB recursively
-    for ob in rpass.objects:
-        export_object(file, rpass, scene, ob, motion)
+    if fragment_pool is None:
+        for ob in objects:
+            export_object(file, rpass, scene, ob, motion)
+        return
+    
+    # extract data on the main thread, while worker processes
+    # turn it into RIB, in the same order as the objects
+    for ob in objects:
+        fragment = file.recorder()
+        export_object(fragment, rpass, scene, ob, motion)
+        fragment_pool.submit(file, fragment)
+    
+    fragment_pool.drain(file)
+
+
+# Shard files, for splitting the world block
+SHARD_MANIFEST = 'shards.json'
+
+def shard_dir(paths):
+    root = paths['rib_output']
+    if root.endswith('.gz'):
+        root = root[:-3]
+    return os.path.splitext(root)[0] + '_shards'
+
+# file name for a shard, kept stable between exports so unchanged shards aren't rewritten
+def shard_filename(name, paths):
+    safe = re.sub(r'[^\w.-]', '_', name)
+    if safe != name:
+        safe += '_' + hashlib.sha1(name.encode()).hexdigest()[:8]
+    return safe + paths['rib_extension']
+
+def shard_key(ob, mode):
+    if mode == 'MATERIAL':
+        if ob.data and hasattr(ob.data, 'materials'):
+            for mat in ob.data.materials:
+                if mat != None:
+                    return mat.name
+        return 'default'
+    return ob.name
+
+# Export the objects into separate shard files, each read from the main RIB.
+# Shards are written concurrently, and only when their contents have changed.
+def export_objects_sharded(file, rpass, scene, motion):
+    rm = scene.renderman
+    directory = shard_dir(rpass.paths)
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    
+    file.comment('# Objects')
+    file.newline()
+    
+    manifest_path = os.path.join(directory, SHARD_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = {}
+    
+    objects = visible_objects(rpass, motion)
+    export_instances(file, rpass, scene, objects, motion)
+    
+    # group objects into shards, in export order
+    shards = []
+    by_key = {}
+    budget = rm.rib_shard_size*1024*1024
+    
+    for ob in objects:
+        if ob.type in ('LAMP', 'CAMERA'):
+            continue
+        
+        if rm.rib_shards == 'SIZE':
+            if not shards or shards[-1][1].bytes_written >= budget:
+                shards.append(('shard_%04d' % len(shards), file.recorder()))
+            fragment = shards[-1][1]
+        else:
+            key = shard_key(ob, rm.rib_shards)
+            if key not in by_key:
+                by_key[key] = file.recorder()
+                shards.append((key, by_key[key]))
+            fragment = by_key[key]
+        
+        fragment.depth = 0
+        export_object(fragment, rpass, scene, ob, motion)
+    
+    jobs = []
+    compression = rm.rib_compression_level if rm.rib_compression else 0
+    for name, fragment in shards:
+        path = os.path.join(directory, shard_filename(name, rpass.paths))
+        fragment.flush_buffer()
+        file.merge_stats(fragment)
+        jobs.append((path, fragment.stream.items, rm.rib_format == 'BINARY', compression, manifest.get(path)))
+    
+    results = write_shards(jobs, fragment_pool)
+    
+    # remove shards left over from earlier exports
+    current = set(job[0] for job in jobs)
+    for path in manifest:
+        if path not in current and os.path.exists(path):
+            os.remove(path)
+    
+    manifest = dict((job[0], digest) for job, (digest, written) in zip(jobs, results))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    
+    for path in [job[0] for job in jobs]:
+        file.request('ReadArchive', rib_path(path))
+    
+    print('Shards: %d of %d rewritten in %s' %
+        (len([r for r in results if r[1]]), len(results), directory))
+
+
+# worker processes used by export_objects(), while exporting a scene
+fragment_pool = None
+
+def open_fragment_pool(scene):
+    global fragment_pool
+    rm = scene.renderman
+    
+    processes = rm.export_processes if rm.export_processes > 0 else multiprocessing.cpu_count()
+    if processes < 2:
+        return
+    
+    # workers are plain python processes, not copies of blender
+    fragment_pool = FragmentPool(processes, binary=(rm.rib_format == 'BINARY'),
+                                executable=bpy.app.binary_path_python)
+
+def close_fragment_pool():
+    global fragment_pool
+    
+    if fragment_pool is not None:
+        fragment_pool.close()
+        fragment_pool = None
 
 
 def export_archive(scene, objects, filepath="", archive_motion=True, animated=True, frame_start=1, frame_end=3):
@@ -1505,23 +2844,37 @@ def export_archive(scene, objects, filepath="", archive_motion=True, animated=Tr
     if frame_start == frame_end:
         animated = False
     
+    # a file name chosen by the user is kept as it is, even when compressed,
+    # automatic ones already have the compressed extension
     if filepath == "":
         filepath = auto_archive_path(paths, objects, create_folder=True)
     
+    previous = None
+    
     for frame in range(frame_start, frame_end+1):
-        scene.frame_set(frame)
-        
-        motion = export_motion(rpass, scene) if archive_motion else empty_motion()
+        # export_motion() finishes on the frame itself
+        if archive_motion and rpass.motion_blur:
+            motion = export_motion(rpass, scene, previous=previous, origframe=frame)
+        else:
+            scene.frame_set(frame)
+            motion = empty_motion()
         ribpath = anim_archive_path(filepath, frame) if animated else filepath
 
         
-        file = open(ribpath, "w")
+        file = open_scene_rib(scene, ribpath)
         export_header(file)
         
         for ob in rpass.objects:
             export_geometry_data(file, rpass, scene, ob, motion)
     
         file.close()
+        
+        # keep the samples around for the next frame to reuse
+        if previous != None:
+            close_motion(previous)
+        previous = motion
+    
+    close_motion(previous)
     
     return file.name
 
@@ -1552,17 +2905,17 @@ def export_integrator(file, rpass, scene):
 def export_world_coshaders(file, rpass, scene):
     rm = scene.world.renderman
 
-    file.write('    ## World Co-shaders\n')
+    file.comment('# World Co-shaders')
     for cosh_item in rm.coshaders.items():
         coshader_handle = cosh_item[0]
         coshader_name = cosh_item[1].shader_shaders.active
-        file.write('    Shader "%s" "%s"\n' % (coshader_name, coshader_handle) )
+        file.request('Shader', coshader_name, coshader_handle)
         parameterlist = rna_to_shaderparameters(scene, cosh_item[1], 'shader')
         for sp in parameterlist:
             if sp.is_array:
-                file.write('        "%s %s[%d]" %s\n' % (sp.data_type, sp.name, len(sp.value), rib(sp.value,is_cosh_array=True)))
+                file.param('%s %s[%d]' % (sp.data_type, sp.name, len(sp.value)), sp.value)
             else:
-                file.write('        "%s %s" %s\n' % (sp.data_type, sp.name, rib(sp.value)))
+                file.param('%s %s' % (sp.data_type, sp.name), sp.value)
 				
 # BBM addition end
 
@@ -1575,11 +2928,12 @@ def export_global_illumination_lights(file, rpass, scene):
     
     if not rm.global_illumination: return
     
-    file.write('    ## GI lights \n\n')
+    file.comment('# GI lights')
+    file.newline()
     
-    file.write('    AttributeBegin\n')
-    file.write('    Attribute "light" "emitphotons" [ "%s" ] \n' % ('on' if rm.gi_primary.light_shaders.active == 'gi_photon' else 'off'))
-    file.write('    LightSource "%s" "indirectambient" \n' % rm.gi_primary.light_shaders.active)
+    file.begin('Attribute')
+    file.request('Attribute', 'light', 'emitphotons', ['on' if rm.gi_primary.light_shaders.active == 'gi_photon' else 'off'])
+    file.request('LightSource', rm.gi_primary.light_shaders.active, 'indirectambient')
     
     parameterlist = rna_to_shaderparameters(scene, rm.gi_primary, 'light')
    
@@ -1587,14 +2941,14 @@ def export_global_illumination_lights(file, rpass, scene):
     for sp in parameterlist:
 		# BBM addition begin
         if sp.is_array:
-            file.write('            "%s %s[%d]" %s\n' % (sp.data_type, sp.name, len(sp.value), rib(sp.value,is_cosh_array=True)))
+            file.param('%s %s[%d]' % (sp.data_type, sp.name, len(sp.value)), sp.value)
         else:
 		# BBM addition end
-            file.write('            "%s %s" %s\n' % (sp.data_type, sp.name, rib(sp.value)))
+            file.param('%s %s' % (sp.data_type, sp.name), sp.value)
         
-    file.write('    AttributeEnd\n')
-    file.write('    Illuminate "indirectambient" 1 \n');
-    file.write('\n');
+    file.end('Attribute')
+    file.request('Illuminate', 'indirectambient', 1)
+    file.newline()
 
 def export_global_illumination_settings(file, rpass, scene):
     rm = scene.world.renderman
@@ -1603,25 +2957,26 @@ def export_global_illumination_settings(file, rpass, scene):
     
     if not rm.global_illumination: return
     
-    file.write('Option "user" "string gi_primary" [ "%s" ] \n' % gi_primary.light_shaders.active)
-    file.write('Option "user" "string gi_secondary" [ "%s" ] \n' % gi_secondary.light_shaders.active)
+    file.request('Option', 'user', 'string gi_primary', [gi_primary.light_shaders.active])
+    file.request('Option', 'user', 'string gi_secondary', [gi_secondary.light_shaders.active])
 
     if gi_primary.light_shaders.active == 'gi_pointcloud':
         if rpass.type == 'ptc_indirect':
-            file.write('Option "user" "string delight_gi_ptc_bake_path" [ "%s" ] \n' % rib_path(rpass.paths["gi_ptc_bake_path"]))
+            file.request('Option', 'user', 'string delight_gi_ptc_bake_path', [rib_path(rpass.paths["gi_ptc_bake_path"])])
             
     if gi_secondary.light_shaders.active == 'gi_photon' or \
         gi_primary.light_shaders.active == 'gi_photon':
 
         # XXX todo, figure out decisions for photon emission
         
-        file.write('Option "photon" "integer emit" [ %d ] \n' % gi_secondary.photon_count)
+        file.request('Option', 'photon', 'integer emit', [gi_secondary.photon_count])
         
-        file.write('Attribute "photon" \n')
-        file.write('    "string globalmap" [ "%s" ] \n' %  gi_secondary.photon_map_global)
-        file.write('    "string causticmap" [ "%s" ] \n' %  gi_secondary.photon_map_caustic)
+        file.request('Attribute', 'photon')
+        file.param('string globalmap', [gi_secondary.photon_map_global])
+        file.param('string causticmap', [gi_secondary.photon_map_caustic])
         
-    file.write('\n\n')
+    file.newline()
+    file.newline()
 
 
 def render_get_resolution(r):
@@ -1659,36 +3014,36 @@ def export_render_settings(file, rpass, scene):
     rm = scene.renderman
     r = scene.render
     
-    file.write('Option "render" "integer nthreads" %d\n' % rm.threads)
-    file.write('Option "trace" "integer maxdepth" [%d]\n' % rm.max_trace_depth)
-    file.write('Attribute "trace" "integer maxspeculardepth" [%d]\n' % rm.max_specular_depth)
-    file.write('Attribute "trace" "integer maxdiffusedepth" [%d]\n' % rm.max_diffuse_depth)
-    file.write('Option "limits" "integer eyesplits" %d\n' % rm.max_eye_splits)
-    file.write('Option "trace" "float approximation" %f\n' % rm.trace_approximation)
+    file.request('Option', 'render', 'integer nthreads', rpass.threads if rpass.threads else rm.threads)
+    file.request('Option', 'trace', 'integer maxdepth', [rm.max_trace_depth])
+    file.request('Attribute', 'trace', 'integer maxspeculardepth', [rm.max_specular_depth])
+    file.request('Attribute', 'trace', 'integer maxdiffusedepth', [rm.max_diffuse_depth])
+    file.request('Option', 'limits', 'integer eyesplits', rm.max_eye_splits)
+    file.request('Option', 'trace', 'float approximation', rm.trace_approximation)
     if rm.use_statistics:
-        file.write('Option "statistics" "endofframe" %d "filename" "/tmp/stats.txt" \n' % rm.statistics_level    )
+        file.request('Option', 'statistics', 'endofframe', rm.statistics_level, 'filename', '/tmp/stats.txt')
     
     rpass.resolution = render_get_resolution(r)
 
-    file.write('Format %d %d %f\n' % (rpass.resolution[0], rpass.resolution[1], 1.0))
-    file.write('PixelSamples %d %d \n' % (rm.pixelsamples_x, rm.pixelsamples_y))
-    file.write('PixelFilter "%s" %d %d \n' % (rm.pixelfilter, rm.pixelfilter_x, rm.pixelfilter_y))
-    file.write('ShadingRate %f \n' % rm.shadingrate )
-    file.write('\n')
+    file.request('Format', rpass.resolution[0], rpass.resolution[1], 1.0)
+    file.request('PixelSamples', rm.pixelsamples_x, rm.pixelsamples_y)
+    file.request('PixelFilter', rm.pixelfilter, rm.pixelfilter_x, rm.pixelfilter_y)
+    file.request('ShadingRate', rm.shadingrate)
+    file.newline()
 
 def export_render_settings_preview(file, rpass, scene):
     r = scene.render
     rpass.resolution = render_get_resolution(r)
     
-    file.write('Format %d %d %f\n' % (rpass.resolution[0], rpass.resolution[1], 1.0))
-    file.write('PixelSamples 2 2 \n')
-    file.write('PixelFilter "sinc" 2 2 \n')
+    file.request('Format', rpass.resolution[0], rpass.resolution[1], 1.0)
+    file.request('PixelSamples', 2, 2)
+    file.request('PixelFilter', 'sinc', 2, 2)
 
 def export_camera_matrix(file, scene, ob, motion):
     motion_blur = ob.name in motion['transformation']
     
     if motion_blur:
-        file.write('        MotionBegin %s\n' % rib(get_ob_subframes(scene, ob)))
+        file.begin('Motion', get_ob_subframes(scene, ob, motion))
         samples = motion['transformation'][ob.name]
     else:
         samples = [ob.matrix_world]
@@ -1705,10 +3060,17 @@ def export_camera_matrix(file, scene, ob, motion):
             l = Matrix.Translation(-loc)
             m = s * r * l
 
-            file.write('Transform %s\n' % rib(m))
+            file.request('Transform', m)
 
     if motion_blur:
-        file.write('        MotionEnd\n')
+        file.end('Motion')
+
+def camera_dof_distance(ob):
+    cam = ob.data
+    if cam.dof_object:
+        return (ob.location - cam.dof_object.location).length
+    else:
+        return cam.dof_distance
 
 def export_camera(file, scene, motion):
     
@@ -1723,17 +3085,13 @@ def export_camera(file, scene, motion):
     xaspect, yaspect, aspectratio = render_get_aspect(r, cam)
     
     if rm.depth_of_field:
-        if cam.dof_object:
-            dof_distance = (ob.location - cam.dof_object.location).length
-        else:
-            dof_distance = cam.dof_distance
-        file.write('DepthOfField %f 1.0 %f\n' % (rm.fstop, dof_distance))
+        file.request('DepthOfField', rm.fstop, 1.0, camera_dof_distance(ob))
         
     if scene.renderman.motion_blur:
-        file.write('Shutter %f %f\n' % (rm.shutter_open, rm.shutter_close))
-        file.write('Option "shutter" "efficiency" [ %f %f ] \n' % (rm.shutter_efficiency_open, rm.shutter_efficiency_close))
+        file.request('Shutter', rm.shutter_open, rm.shutter_close)
+        file.request('Option', 'shutter', 'efficiency', [rm.shutter_efficiency_open, rm.shutter_efficiency_close])
 
-    file.write('Clipping %f %f\n' % (cam.clip_start, cam.clip_end))
+    file.request('Clipping', cam.clip_start, cam.clip_end)
     
     if cam.type == 'PERSP':
         lens= cam.lens
@@ -1742,28 +3100,29 @@ def export_camera(file, scene, motion):
 
         fov= 360.0*math.atan((sensor*0.5)/lens/aspectratio)/math.pi
 
-        file.write('Projection "perspective" "fov" %f\n' % fov)
+        file.request('Projection', 'perspective', 'fov', fov)
     else:
         lens= cam.ortho_scale
         xaspect= xaspect*lens/(aspectratio*2.0)
         yaspect= yaspect*lens/(aspectratio*2.0)
-        file.write('Projection "orthographic"\n')
+        file.request('Projection', 'orthographic')
 
-    file.write('ScreenWindow %f %f %f %f\n' % (-xaspect, xaspect, -yaspect, yaspect))
+    file.request('ScreenWindow', -xaspect, xaspect, -yaspect, yaspect)
 
     export_camera_matrix(file, scene, ob, motion)
-    file.write('\n')
+    file.newline()
 
 def export_camera_render_preview(file, scene):
     r = scene.render
 
     xaspect, yaspect, aspectratio = render_get_aspect(r)
 
-    file.write('Clipping 0.100000 100.000000 \n')
-    file.write('Projection "perspective" "fov" 28.841546 \n')
-    file.write('ScreenWindow %f %f %f %f\n' % (-xaspect, xaspect, -yaspect, yaspect))
+    file.request('Clipping', 0.1, 100.0)
+    file.request('Projection', 'perspective', 'fov', 28.841546)
+    file.request('ScreenWindow', -xaspect, xaspect, -yaspect, yaspect)
 
-    file.write('Transform [ 0.685881 -0.317370 -0.654862 0.000000 0.727634 0.312469 0.610666 0.000000 -0.010817 0.895343 -0.445245 0.000000 0.040019 -0.661400 6.220541 1.000000 ] \n')
+    file.request('Transform', [0.685881, -0.317370, -0.654862, 0.000000, 0.727634, 0.312469, 0.610666, 0.000000,
+                               -0.010817, 0.895343, -0.445245, 0.000000, 0.040019, -0.661400, 6.220541, 1.000000])
     
 
 def export_camera_shadowmap(file, scene, ob, motion):
@@ -1771,23 +3130,22 @@ def export_camera_shadowmap(file, scene, ob, motion):
     rm = lamp.renderman
     srm = scene.renderman
     
-    file.write('Format %d %d %f\n' % (int(rm.shadow_map_resolution), int(rm.shadow_map_resolution), 1.0))
+    file.request('Format', int(rm.shadow_map_resolution), int(rm.shadow_map_resolution), 1.0)
     
     if rm.shadow_transparent:
-        file.write('PixelSamples %d %d \n' % 
-                    (rm.pixelsamples_x, rm.pixelsamples_y))
-        file.write('PixelFilter "box" 1 1 \n')
+        file.request('PixelSamples', rm.pixelsamples_x, rm.pixelsamples_y)
+        file.request('PixelFilter', 'box', 1, 1)
 
-    file.write('ShadingRate %f \n' % rm.shadingrate )
-    file.write('\n') 
+    file.request('ShadingRate', rm.shadingrate)
+    file.newline()
     
     if rm.light_shaders.active != '':
         params = rna_to_shaderparameters(scene, rm, 'light')
         for sp in params:
             if sp.meta == 'distant_scale':
                 xaspect = yaspect = sp.value / 2.0
-                file.write('Projection "orthographic"\n')
-                file.write('ScreenWindow %f %f %f %f\n' % (-xaspect, xaspect, -yaspect, yaspect))
+                file.request('Projection', 'orthographic')
+                file.request('ScreenWindow', -xaspect, xaspect, -yaspect, yaspect)
                 
     '''
     if lamp.type == 'SPOT':
@@ -1802,25 +3160,38 @@ def export_camera_shadowmap(file, scene, ob, motion):
         file.write('ScreenWindow %f %f %f %f\n' % (-xaspect, xaspect, -yaspect, yaspect))
     '''
     if scene.renderman.motion_blur:
-        file.write('Shutter %f %f\n' % (srm.shutter_open, srm.shutter_close))
-        file.write('Option "shutter" "efficiency" [ %f %f ] \n' % 
-            (srm.shutter_efficiency_open, srm.shutter_efficiency_close))    
+        file.request('Shutter', srm.shutter_open, srm.shutter_close)
+        file.request('Option', 'shutter', 'efficiency', [srm.shutter_efficiency_open, srm.shutter_efficiency_close])
     
     export_camera_matrix(file, scene, ob, motion)
     
-    file.write('\n')
+    file.newline()
             
 
 def export_searchpaths(file, paths):
-    file.write('Option "searchpath" "string shader" "%s"\n' % ':'.join(path_list_convert(paths['shader'], to_unix=True)))
-    file.write('Option "searchpath" "string texture" "%s"\n' % ':'.join(path_list_convert(paths['texture'], to_unix=True)))
-    file.write('Option "searchpath" "string procedural" "%s"\n' % ':'.join(path_list_convert(paths['procedural'], to_unix=True)))
-    file.write('Option "searchpath" "string archive" "%s"\n' % ':'.join(path_list_convert(paths['archive'], to_unix=True)))
-    file.write('\n')
+    for type in ('shader', 'texture', 'procedural', 'archive'):
+        file.request('Option', 'searchpath', 'string %s' % type, ':'.join(path_list_convert(paths[type], to_unix=True)))
+    file.newline()
+
+# Open a RIB file for writing, in the encoding and compression
+# chosen in the scene's output settings
+def open_scene_rib(scene, path):
+    rm = scene.renderman
+    compression = rm.rib_compression_level if rm.rib_compression else 0
+    
+    return open_rib(path, binary=(rm.rib_format == 'BINARY'), compression=compression,
+                    precision=rm.rib_float_precision)
+
+# Add the .gz extension to RIB paths when writing compressed RIB
+def scene_rib_path(scene, path):
+    if scene.renderman.rib_compression:
+        return compressed_path(path)
+    return path
 
 def export_header(file):
-    file.write('# Generated by 3Delight exporter for Blender, v%s.%s.%s \n' % (addon_version[0], addon_version[1], addon_version[2]))
-    file.write('# By Matt Ebb - matt (at) mattebb (dot) com\n\n')
+    file.comment('Generated by 3Delight exporter for Blender, v%s.%s.%s' % (addon_version[0], addon_version[1], addon_version[2]))
+    file.comment('By Matt Ebb - matt (at) mattebb (dot) com')
+    file.newline()
 
 def ptc_generate_required(scene):
     rm = scene.world.renderman
@@ -1845,7 +3216,7 @@ def shadowmap_generate_required(scene, ob):
     return False
 
 
-def make_ptc_indirect(paths, scene, info_callback):
+def make_ptc_indirect(paths, scene, info_callback, evaluation=None, jobs=None):
     if not ptc_generate_required(scene):
         return
     
@@ -1854,25 +3225,32 @@ def make_ptc_indirect(paths, scene, info_callback):
     rm = scene.world.renderman
     
     rpass = RPass(scene, renderable_objects(scene), paths, "ptc_indirect")
+    if jobs != None:
+        rpass.threads = jobs.threads_per_job()
     
     # prepare paths for point cloud and rib output
     paths['gi_ptc_bake_path'] = user_path(rm.gi_secondary.ptc_path, scene=scene)
-    ptc_rib = os.path.splitext(paths['gi_ptc_bake_path'])[0] + '.rib'
+    ptc_rib = os.path.splitext(paths['gi_ptc_bake_path'])[0] + paths['rib_extension']
     
     paths['pointcloud_dir'] = os.path.dirname(paths['gi_ptc_bake_path'])
     if not os.path.exists(paths['pointcloud_dir']):
         os.mkdir(paths['pointcloud_dir'])
 
-    file = open(ptc_rib, "w")
+    file = open_scene_rib(scene, ptc_rib)
+    open_pass_caches(rpass, scene, evaluation)
     
-    motion = empty_motion()
+    if evaluation != None:
+        motion = evaluation.motion_for(rpass)
+    else:
+        motion = empty_motion()
+        scene.frame_set(scene.frame_current)
     
     export_header(file)
     export_searchpaths(file, paths)
     export_inline_rib(file, rpass, scene)
     
-    scene.frame_set(scene.frame_current)
-    file.write('FrameBegin %d\n\n' % scene.frame_current)
+    file.begin('Frame', scene.frame_current)
+    file.newline()
     
     export_camera(file, scene, motion)
     export_render_settings(file, rpass, scene)
@@ -1882,30 +3260,40 @@ def make_ptc_indirect(paths, scene, info_callback):
     # to bake shading to a point cloud
     
     # ptc related attributes
-    file.write('Attribute "cull" "hidden" [0] \n')
-    file.write('Attribute "cull" "backfacing" [0] \n')
-    file.write('Attribute "dice" "rasterorient" [0] \n')
-    file.write('PixelSamples 1 1 \n')
-    file.write('PixelFilter "box" 1 1 \n')
-    file.write('ShadingRate %f \n' % rm.gi_secondary.ptc_shadingrate)
+    file.request('Attribute', 'cull', 'hidden', [0])
+    file.request('Attribute', 'cull', 'backfacing', [0])
+    file.request('Attribute', 'dice', 'rasterorient', [0])
+    file.request('PixelSamples', 1, 1)
+    file.request('PixelFilter', 'box', 1, 1)
+    file.request('ShadingRate', rm.gi_secondary.ptc_shadingrate)
 
-    file.write('WorldBegin\n\n')
+    file.begin('World')
+    file.newline()
     
     export_global_illumination_lights(file, rpass, scene)
     export_scene_lights(file, rpass, scene)    
     export_objects(file, rpass, scene, motion)
     
-    file.write('WorldEnd\n\n')
-    file.write('FrameEnd\n\n')
+    file.end('World')
+    file.end('Frame')
+    file.newline()
     
     file.close()
+    close_fragment_cache(rpass)
+    if evaluation == None:
+        close_motion(motion)
     
-    # render and bake the pointcloud
+    # render and bake the pointcloud, after any shadow maps its lights use
     # set cwd to pointcloud_dir to work around windows paths issue -
     # bake3d() doesn't seem to like baking windows absolute paths, so we use relative
-    proc = subprocess.Popen([rpass.paths['rman_binary'], ptc_rib], cwd=rpass.paths['export_dir']).wait()
+    cmd = [rpass.paths['rman_binary'], ptc_rib]
+    if jobs != None:
+        jobs.submit('point cloud', cmd, cwd=rpass.paths['export_dir'],
+                    outputs=[paths['gi_ptc_bake_path']], inputs=rpass.dependencies)
+    else:
+        proc = subprocess.Popen(cmd, cwd=rpass.paths['export_dir']).wait()
 
-def make_shadowmaps(paths, scene, info_callback):
+def make_shadowmaps(paths, scene, info_callback, evaluation=None, jobs=None):
 
     info_callback('Creating Shadow maps')
 
@@ -1914,6 +3302,27 @@ def make_shadowmaps(paths, scene, info_callback):
     rpass = RPass(scene, render_objects, paths, "shadowmap")    
     
     shadow_lamps = [ob for ob in rpass.objects if shadowmap_generate_required(scene, ob) ]
+    if not shadow_lamps:
+        return
+    
+    open_pass_caches(rpass, scene, evaluation)
+    
+    # shadow map renders may finish on the job scheduler's thread
+    shadow_cache = open_shadowmap_cache(scene, paths)
+    shadow_cache_lock = threading.Lock()
+    
+    def shadowmap_rendered(path, digest, returncode):
+        if shadow_cache == None or returncode != 0:
+            return
+        with shadow_cache_lock:
+            shadow_cache.set_archive(path, digest)
+            shadow_cache.save()
+    
+    # motion is the same for every lamp, so it's only collected once
+    own_evaluation = evaluation == None
+    if own_evaluation:
+        evaluation = FrameEvaluation(rpass, scene)
+    motion = evaluation.motion_for(rpass)
     
     for ob in shadow_lamps:
         rm = ob.data.renderman
@@ -1924,38 +3333,97 @@ def make_shadowmaps(paths, scene, info_callback):
         if not os.path.exists(rpass.paths['shadowmap_dir']):
             os.mkdir(rpass.paths['shadowmap_dir'])
         
-        shadow_rib = os.path.splitext(paths['shadow_map'])[0] + '.rib'
-        file = open(shadow_rib, "w")
+        shadow_rib = os.path.splitext(paths['shadow_map'])[0] + paths['rib_extension']
+        file = open_scene_rib(scene, shadow_rib)
         
         export_header(file)
         export_searchpaths(file, rpass.paths)
         
         if rm.shadow_transparent:
-            file.write('Display "%s" "dsm" "rgbaz" \n\n' % rib_path( paths['shadow_map'], escape_slashes=True ))
+            file.request('Display', rib_path( paths['shadow_map'], escape_slashes=True ), 'dsm', 'rgbaz')
         else:
-            file.write('Display "%s" "shadowmap" "z" \n\n' % rib_path( paths['shadow_map'], escape_slashes=True ))
+            file.request('Display', rib_path( paths['shadow_map'], escape_slashes=True ), 'shadowmap', 'z')
+        file.newline()
         
+        # hash everything but the output path and frame number,
+        # so maps can be reused across frames
+        digest = hashlib.sha1()
+        digest.update(repr((addon_version, rm.shadow_transparent, rpass.paths['rman_binary'])).encode())
+        file.digest = digest
 
         export_inline_rib(file, rpass, scene, lamp=ob.data)
         
-        scene.frame_set(scene.frame_current)
-        file.write('FrameBegin %d\n\n' % scene.frame_current)
-        
-        motion = export_motion(rpass, scene) 
+        file.digest = None
+        file.begin('Frame', scene.frame_current)
+        file.digest = digest
+        file.newline()
         
         export_camera_shadowmap(file, scene, ob, motion)
         
-        file.write('WorldBegin\n\n')
+        file.begin('World')
+        file.newline()
         
+        # only objects in the lamp's projection can cast shadows in its map
+        if scene.renderman.shadowmap_culling:
+            rpass.frustums = shadowmap_frustums(scene, ob, motion)
+        
+        rpass.archive_reads = {}
         export_objects(file, rpass, scene, motion)
+        archive_reads_digest(digest, rpass.archive_reads)
+        
+        if rpass.frustums != None:
+            print("Shadow map for %s: %d of %d objects culled" % (ob.name, len(rpass.culled), len(rpass.objects)))
+            rpass.frustums = None
         
-        file.write('WorldEnd\n\n')
-        file.write('FrameEnd\n\n')
+        file.end('World')
+        file.end('Frame')
+        file.newline()
         
         file.close()
+        digest = digest.hexdigest()
+        
+        if shadow_cache != None:
+            with shadow_cache_lock:
+                reused = reuse_shadowmap(shadow_cache, paths['shadow_map'], digest)
+                if not reused:
+                    # not to be copied from while it's being rendered
+                    shadow_cache.set_archive(paths['shadow_map'], None)
+            if reused:
+                print("Reusing unchanged shadow map for %s" % ob.name)
+                continue
         
         # render the shadow map
-        proc = subprocess.Popen([rpass.paths['rman_binary'], shadow_rib]).wait()
+        cmd = [rpass.paths['rman_binary'], shadow_rib]
+        if jobs != None:
+            on_done = lambda job, path=paths['shadow_map'], digest=digest: \
+                    shadowmap_rendered(path, digest, job.returncode)
+            jobs.submit(ob.name + ' shadow map', cmd, outputs=[paths['shadow_map']], on_done=on_done)
+        else:
+            proc = subprocess.Popen(cmd).wait()
+            shadowmap_rendered(paths['shadow_map'], digest, proc)
+    
+    if shadow_cache != None:
+        with shadow_cache_lock:
+            shadow_cache.save()
+    
+    close_fragment_cache(rpass)
+    if own_evaluation:
+        evaluation.close()
+
+
+# True if the shadow map at path was already rendered from the same RIB,
+# or could be copied from another frame's map rendered from the same RIB
+def reuse_shadowmap(cache, path, digest):
+    if cache.archive_current(path, digest):
+        return True
+    
+    source = cache.find_archive(digest)
+    if source == None:
+        return False
+    
+    shutil.copyfile(source, path)
+    cache.set_archive(path, digest)
+    return True
 
 
 def find_preview_material(scene):
@@ -2005,16 +3473,16 @@ def find_preview_material(scene):
     
 # --------------- End Hopefully temporary --------------- #
 
-def preview_model(mat):
+def export_preview_model(file, mat):
     if mat.preview_render_type == 'SPHERE':
-        return '        Sphere 1 -1 1 360 \n'
+        file.request('Sphere', 1, -1, 1, 360)
     else: # CUBE
-        return '        Scale 0.75 0.75 0.75 \n \
-        Translate 0.0 0.0 0.01 \n \
-        PointsPolygons \n \
-        [ 4 4 4 4 4 4 ] \n \
-        [ 0 1 2 3 4 7 6 5 0 4 5 1 1 5 6 2 2 6 7 3 4 0 3 7 ] \n \
-        "P" [ 1 1 -1  1 -1 -1  -1 -1 -1  -1 1 -1  1 1 1  1 -1 1  -1 -1 1  -1 1 1 ] \n'
+        file.request('Scale', 0.75, 0.75, 0.75)
+        file.request('Translate', 0.0, 0.0, 0.01)
+        file.request('PointsPolygons')
+        file.array([4, 4, 4, 4, 4, 4])
+        file.array([0, 1, 2, 3, 4, 7, 6, 5, 0, 4, 5, 1, 1, 5, 6, 2, 2, 6, 7, 3, 4, 0, 3, 7])
+        file.param('P', [1, 1, -1,  1, -1, -1,  -1, -1, -1,  -1, 1, -1,  1, 1, 1,  1, -1, 1,  -1, -1, 1,  -1, 1, 1])
         
 
 def write_preview_rib(rpass, scene):
@@ -2029,70 +3497,79 @@ def write_preview_rib(rpass, scene):
     if not os.path.exists(rpass.paths['export_dir']):
         os.mkdir(rpass.paths['export_dir'])
     
-    file = open(rpass.paths['rib_output'], "w")
+    file = open_rib(rpass.paths['rib_output'])
     
     export_header(file)
     export_searchpaths(file, rpass.paths)
     
     # temporary tiff display to be read back into blender render result
-    file.write('Display "%s" "tiff" "rgba" "quantize" [0 0 0 0] \n\n' % os.path.basename(rpass.paths['render_output']))
+    file.request('Display', os.path.basename(rpass.paths['render_output']), 'tiff', 'rgba', 'quantize', [0, 0, 0, 0])
+    file.newline()
     
-    file.write('FrameBegin 1 \n\n')
+    file.begin('Frame', 1)
+    file.newline()
     
     export_camera_render_preview(file, scene)
     export_render_settings_preview(file, rpass, scene)
 
-    file.write('WorldBegin\n\n')
+    file.begin('World')
+    file.newline()
     
     # preview scene: walls, lights
-    file.write('        ReadArchive "%s" \n\n' % preview_rib_data_path)
+    file.request('ReadArchive', preview_rib_data_path)
+    file.newline()
     
     # preview model and material
-    file.write('    AttributeBegin\n')
-    file.write('    Attribute "identifier" "name" [ "Preview" ] \n')
-    file.write('        Translate 0 0 0.75 \n')
-    file.write('        Attribute "visibility" \n \
-            "integer camera" [ 1 ] \n \
-            "integer trace" [ 1 ] \n \
-            "integer photon" [ 1 ] \n \
-            "string transmission" ["opaque"] \n ')
-    file.write('        Attribute "trace" "displacements" [1] \n')
+    file.begin('Attribute')
+    file.request('Attribute', 'identifier', 'name', ['Preview'])
+    file.request('Translate', 0, 0, 0.75)
+    file.request('Attribute', 'visibility')
+    file.param('integer camera', [1])
+    file.param('integer trace', [1])
+    file.param('integer photon', [1])
+    file.param('string transmission', ['opaque'])
+    file.request('Attribute', 'trace', 'displacements', [1])
     
     mat = find_preview_material(scene)
     export_material(file, rpass, scene, mat)
-    file.write( preview_model(mat)  )
-    file.write('    AttributeEnd\n')
+    export_preview_model(file, mat)
+    file.end('Attribute')
     
-    file.write('WorldEnd\n\n')
-    file.write('FrameEnd\n\n')
+    file.end('World')
+    file.end('Frame')
+    file.newline()
+    
+    file.close()
 
 def export_display(file, rpass, scene):
     rm = scene.renderman
     
     if rm.display_driver == 'AUTO':
         # temporary tiff display to be read back into blender render result
-        file.write('Display "%s" "tiff" "rgba" "quantize" [0 0 0 0] \n\n' % os.path.basename(rpass.paths['render_output']))
+        file.request('Display', os.path.basename(rpass.paths['render_output']), 'tiff', 'rgba', 'quantize', [0, 0, 0, 0])
+        file.newline()
     elif rm.display_driver == 'idisplay':
         rpass.options.append('-id')
     elif rm.display_driver == 'tiff':
-        file.write('Display "%s" "tiff" "rgba" "quantize" [0 0 0 0] \n\n' % rib_path(user_path(rm.path_display_driver_image, scene=scene)))
+        file.request('Display', rib_path(user_path(rm.path_display_driver_image, scene=scene)), 'tiff', 'rgba', 'quantize', [0, 0, 0, 0])
+        file.newline()
 
 def export_hider(file, rpass, scene):
     rm = scene.renderman
     
     if rm.hider == 'hidden':
-        file.write('Hider "hidden" \n')
-        file.write('    "string depthfilter" "%s" \n' % rm.hidden_depthfilter)
-        file.write('    "integer jitter" [%d] \n' % rm.hidden_jitter)
-        file.write('    "integer samplemotion" [%d] \n' % rm.hidden_samplemotion)
-        file.write('    "integer extrememotiondof" [%d] \n' % rm.hidden_extrememotiondof)
-        file.write('    "integer maxvpdepth" [%d] \n' % rm.hidden_maxvpdepth)
+        file.request('Hider', 'hidden')
+        file.param('string depthfilter', rm.hidden_depthfilter)
+        file.param('integer jitter', [rm.hidden_jitter])
+        file.param('integer samplemotion', [rm.hidden_samplemotion])
+        file.param('integer extrememotiondof', [rm.hidden_extrememotiondof])
+        file.param('integer maxvpdepth', [rm.hidden_maxvpdepth])
         if rm.hidden_depthfilter == 'midpoint':
-            file.write('"float midpointratio" [%f] \n' % rm.hidden_midpointratio)
+            file.param('float midpointratio', [rm.hidden_midpointratio])
         
     elif rm.hider == 'raytrace':
-        file.write('Hider "raytrace" \n')
-        file.write('    "int progressive" [%d] \n' % rm.raytrace_progressive)
+        file.request('Hider', 'raytrace')
+        file.param('int progressive', [rm.raytrace_progressive])
 	
 	
 def export_inline_rib(file, rpass, scene, lamp=None ):
@@ -2106,22 +3583,28 @@ def export_inline_rib(file, rpass, scene, lamp=None ):
     else:
         txts = rm.bty_inlinerib_texts
 
-    file.write( '\n# Inline RIB \n' )
+    file.newline()
+    file.comment('Inline RIB')
 
     for txt in txts:
         textblock = bpy.data.texts[txt.name]
         for l in textblock.lines:
             file.write( '%s \n' % l.body )    
 
-    file.write( '\n' )
+    file.newline()
 
-def write_rib(rpass, scene, info_callback):
+def write_rib(rpass, scene, info_callback, evaluation=None):
     info_callback('Generating RIB')
     
     # precalculate motion blur data
-    motion = export_motion(rpass, scene)
+    if evaluation != None:
+        motion = evaluation.motion_for(rpass)
+    else:
+        motion = export_motion(rpass, scene)
+        scene.frame_set(scene.frame_current)
     
-    file = open(rpass.paths['rib_output'], "w")
+    file = open_scene_rib(scene, rpass.paths['rib_output'])
+    open_pass_caches(rpass, scene, evaluation)
     
     export_header(file)
     export_searchpaths(file, rpass.paths)
@@ -2130,24 +3613,44 @@ def write_rib(rpass, scene, info_callback):
     export_hider(file, rpass, scene)
     export_inline_rib(file, rpass, scene)
     
-    scene.frame_set(scene.frame_current)
-    file.write('FrameBegin %d\n\n' % scene.frame_current)
+    file.begin('Frame', scene.frame_current)
+    file.newline()
     
     export_camera(file, scene, motion)
     export_render_settings(file, rpass, scene)
     #export_global_illumination_settings(file, rpass, scene)
     
-    file.write('WorldBegin\n\n')
+    file.begin('World')
+    file.newline()
 
     #export_global_illumination_lights(file, rpass, scene)
     #export_world_coshaders(file, rpass, scene) # BBM addition
     export_integrator(file, rpass, scene)
     export_scene_lights(file, rpass, scene)
-    export_objects(file, rpass, scene, motion)
     
-    file.write('WorldEnd\n\n')
-
-    file.write('FrameEnd\n\n')
+    if scene.renderman.camera_culling:
+        rpass.frustums = camera_frustums(scene, motion)
+    
+    if scene.renderman.rib_shards != 'NONE':
+        export_objects_sharded(file, rpass, scene, motion)
+    else:
+        export_objects(file, rpass, scene, motion)
+    
+    file.end('World')
+    file.end('Frame')
+    file.newline()
+    
+    file.close()
+    print(file.stats_report())
+    
+    if rpass.frustums != None:
+        print(culling_report(rpass))
+        rpass.frustums = None
+    for name, (nbytes, nrequests) in file.object_stats.items():
+        object_rib_sizes[name] = nbytes
+    close_fragment_cache(rpass)
+    if evaluation == None:
+        close_motion(motion)
 
 def initialise_paths(scene):
     paths = {}
@@ -2156,7 +3659,8 @@ def initialise_paths(scene):
     
     paths['blender_exporter'] = os.path.dirname(os.path.realpath(__file__))
    
-    paths['rib_output'] = user_path(scene.renderman.path_rib_output, scene=scene)
+    paths['rib_output'] = scene_rib_path(scene, user_path(scene.renderman.path_rib_output, scene=scene))
+    paths['rib_extension'] = scene_rib_path(scene, '.rib')
     paths['export_dir'] = os.path.dirname(paths['rib_output'])
     
     if not os.path.exists(paths['export_dir']):
@@ -2173,9 +3677,14 @@ def initialise_paths(scene):
 
 def anim_archive_path(filepath, frame):
     if filepath.find("#") != -1:
-        ribpath = make_frame_path(filepath, fr)
+        ribpath = make_frame_path(filepath, frame)
     else:
-        ribpath = os.path.splitext(filepath)[0] + "." + str(frame).zfill(4) + os.path.splitext(filepath)[1]
+        # keep compressed .rib.gz extensions together
+        root, ext = os.path.splitext(filepath)
+        if ext == '.gz':
+            root, rib_ext = os.path.splitext(root)
+            ext = rib_ext + ext
+        ribpath = root + "." + str(frame).zfill(4) + ext
     return ribpath
 
 '''
@@ -2199,8 +3708,25 @@ def export_ptc(scene, objects, filepath=""):
 '''    
 
 def write_auto_archives(paths, scene, info_callback):
+    cache = open_fragment_cache(scene, paths)
+    rpass = RPass(scene, [], paths)
+    
     for ob in archive_objects(scene):
+        # skip rewriting archives that haven't changed since they were last written
+        cacheable = cache != None and not (rpass.motion_blur and has_motion(ob))
+        if cacheable:
+            path = auto_archive_path(paths, [ob], create_folder=True)
+            fingerprint = object_fingerprint(rpass, scene, ob)
+            if cache.archive_current(path, fingerprint):
+                continue
+        
         export_archive(scene, [ob], archive_motion=True, frame_start=scene.frame_current, frame_end=scene.frame_current)
+        
+        if cacheable:
+            cache.set_archive(path, fingerprint)
+    
+    if cache != None:
+        cache.save()
     
 
 def available_licenses():
@@ -2261,12 +3787,41 @@ def update_scene(engine, data, scene):
 
     write_auto_archives(engine.rpass.paths, scene, info_callback)
 
-    make_ptc_indirect(engine.rpass.paths, scene, info_callback)
-    make_shadowmaps(engine.rpass.paths, scene, info_callback)
+    # evaluate the scene once for all the passes
+    passes = 1 + int(ptc_generate_required(scene)) + \
+            len([ob for ob in engine.rpass.objects if shadowmap_generate_required(scene, ob)])
+    
+    # when rendering an animation, the previous frame's motion samples can be reused
+    animation = getattr(engine, 'is_animation', False)
+    if not animation:
+        slide_motion_window(None)
+    
+    # pre-pass renders run in the background while the rest is exported,
+    # shadow maps first since the point cloud pass may use them
+    rm = scene.renderman
+    jobs = JobScheduler(rm.prepass_jobs, rm.threads)
+    engine.rpass.jobs = jobs
     
-    write_rib(engine.rpass, scene, info_callback)
+    open_fragment_pool(scene)
+    evaluation = FrameEvaluation(engine.rpass, scene, passes, motion_window)
+    try:
+        make_shadowmaps(engine.rpass.paths, scene, info_callback, evaluation, jobs)
+        make_ptc_indirect(engine.rpass.paths, scene, info_callback, evaluation, jobs)
+        if ptc_generate_required(scene):
+            engine.rpass.dependencies.add(engine.rpass.paths['gi_ptc_bake_path'])
+        
+        write_rib(engine.rpass, scene, info_callback, evaluation)
+    finally:
+        evaluation.close(keep_motion=animation)
+        slide_motion_window(evaluation.motion if animation else None)
+        close_fragment_pool()
 
     engine.rpass.do_render = True if scene.renderman.output_action == 'EXPORT_RENDER' else False
+    
+    # without a render to wait for them, the pre-passes still need to finish
+    if not engine.rpass.do_render:
+        info_callback('Rendering pre-passes')
+        jobs.wait_all()
 
 
 # hopefully temporary
@@ -2303,6 +3858,15 @@ def render_rib(engine):
     
     render_output = engine.rpass.paths['render_output']
     
+    # wait for the shadow maps and point clouds the beauty render reads
+    jobs = engine.rpass.jobs
+    if jobs != None:
+        engine.update_stats("", "3Delight: Rendering pre-passes")
+        while not jobs.wait_for(engine.rpass.dependencies, timeout=DELAY):
+            if engine.test_break():
+                jobs.kill()
+                return
+    
 #XXX    engine.rpass.options.append('-q')
     #engine.rpass.options.append('-Progress')
     
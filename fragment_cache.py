@@ -0,0 +1,160 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2011 Matt Ebb
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+# Persistent cache of per-object RIB fragments.
+#
+# Fragments are stored as <fingerprint><extension> in the cache directory,
+# alongside a json manifest recording their size and when they were last
+# used, so the cache can be trimmed back to a maximum size, least recently
+# used first. The fingerprints themselves are computed by the exporter.
+
+import json
+import os
+import time
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class FragmentCache:
+    def __init__(self, directory, extension='.rib', max_size=1024*1024*1024):
+        self.directory = directory
+        self.extension = extension
+        self.max_size = max_size
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+
+        self.fragments = {}
+        self.archives = {}
+
+        # fingerprints referenced by the current export, never evicted
+        self.in_use = set()
+
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        self.fragments = manifest.get('fragments', {})
+        self.archives = manifest.get('archives', {})
+
+    def save(self):
+        self.evict()
+
+        manifest = {'fragments': self.fragments, 'archives': self.archives}
+
+        # write to a temporary file first, so an interrupted export
+        # never leaves behind a truncated manifest
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def path(self, fingerprint):
+        return os.path.join(self.directory, fingerprint + self.extension)
+
+    # returns True if a fragment with this fingerprint is already cached
+    def lookup(self, fingerprint):
+        entry = self.fragments.get(fingerprint)
+
+        if entry is None or not os.path.exists(self.path(fingerprint)):
+            self.fragments.pop(fingerprint, None)
+            self.misses += 1
+            return False
+
+        entry['used'] = time.time()
+        self.in_use.add(fingerprint)
+        self.hits += 1
+        return True
+
+    # record a fragment that has just been written to self.path(fingerprint),
+    # along with the archives it reads, {path: fingerprint or None}, and the
+    # [bytes, requests] written for its object before any compression
+    def add(self, fingerprint, name, reads=None, stats=None):
+        self.fragments[fingerprint] = {
+            'object': name,
+            'size': os.path.getsize(self.path(fingerprint)),
+            'used': time.time(),
+            'reads': reads or {},
+            'stats': list(stats) if stats else [0, 0]}
+        self.in_use.add(fingerprint)
+
+    def reads(self, fingerprint):
+        return self.fragments[fingerprint].get('reads', {})
+
+    def stats(self, fingerprint):
+        return self.fragments[fingerprint].get('stats', [0, 0])
+
+    # whole-file archives, which live outside the cache directory and are
+    # only tracked so unchanged archives don't get rewritten every frame
+    def archive_current(self, path, fingerprint):
+        return self.archives.get(path) == fingerprint and os.path.exists(path)
+
+    def set_archive(self, path, fingerprint):
+        self.archives[path] = fingerprint
+
+    # an existing archive with the given fingerprint, at any path, or None
+    def find_archive(self, fingerprint):
+        for path, archive_fingerprint in self.archives.items():
+            if archive_fingerprint == fingerprint and os.path.exists(path):
+                return path
+        return None
+
+    def size(self):
+        return sum(entry['size'] for entry in self.fragments.values())
+
+    # remove least recently used fragments until the cache fits in max_size
+    def evict(self):
+        total = self.size()
+        if total <= self.max_size:
+            return
+
+        lru = sorted(self.fragments.items(), key=lambda item: item[1]['used'])
+
+        for fingerprint, entry in lru:
+            if total <= self.max_size:
+                break
+            if fingerprint in self.in_use:
+                continue
+
+            try:
+                os.remove(self.path(fingerprint))
+            except OSError:
+                pass
+
+            total -= entry['size']
+            del self.fragments[fingerprint]
+
+    def stats_report(self):
+        return 'Fragment cache: %d reused, %d written, %.1f MB in %s' % \
+            (self.hits, self.misses, self.size() / (1024.0*1024.0), self.directory)
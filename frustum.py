@@ -0,0 +1,93 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2011 Matt Ebb
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+
+# View frustums for culling objects against a camera or a lamp's projection.
+#
+# Frustums are in the view's own space, as in blender (looking down -Z),
+# with a world to view matrix. Objects are tested with the world space corners
+# of their bounds, which can include the corners at every motion sample.
+#
+# Matrices are copied into tuples of rows, so a frustum doesn't hold on to
+# the blender matrix it was built from.
+
+import math
+
+
+def transform_point(matrix, point):
+    x, y, z = point
+    return tuple(row[0]*x + row[1]*y + row[2]*z + row[3] for row in matrix[:3])
+
+
+class Frustum:
+    # planes are (a, b, c, d), with points inside where a*x + b*y + c*z + d >= 0
+    def __init__(self, matrix, planes):
+        self.matrix = [tuple(row) for row in matrix]
+        self.planes = planes
+
+    # orthographic window of half_width by half_height, in front of the view
+    @classmethod
+    def orthographic(cls, matrix, half_width, half_height, padding=0.0):
+        w = half_width + padding
+        h = half_height + padding
+        planes = [(1.0, 0.0, 0.0, w), (-1.0, 0.0, 0.0, w),
+                  (0.0, 1.0, 0.0, h), (0.0, -1.0, 0.0, h),
+                  (0.0, 0.0, -1.0, padding)]
+        return cls(matrix, planes)
+
+    # perspective view with the given half angles, in radians
+    @classmethod
+    def perspective(cls, matrix, half_angle_x, half_angle_y, padding=0.0):
+        planes = []
+        for axis, angle in ((0, half_angle_x), (1, half_angle_y)):
+            # planes through the eye, pushed out by padding along their normals
+            s, c = math.sin(angle), math.cos(angle)
+            for sign in (1.0, -1.0):
+                plane = [0.0, 0.0, -s, padding]
+                plane[axis] = sign * c
+                planes.append(tuple(plane))
+        planes.append((0.0, 0.0, -1.0, padding))
+        return cls(matrix, planes)
+
+    # False if every corner is outside the same plane, so the box can't be
+    # in view. Boxes crossing a corner of the frustum may be kept anyway.
+    def contains_box(self, corners):
+        points = [transform_point(self.matrix, p) for p in corners]
+
+        for a, b, c, d in self.planes:
+            if all(a*x + b*y + c*z + d < 0.0 for x, y, z in points):
+                return False
+        return True
+
+
+# True if the box is in view of any of the frustums, eg. one for each
+# motion sample of a moving lamp
+def any_contains_box(frustums, corners):
+    return any(frustum.contains_box(corners) for frustum in frustums)
+
+
+# corners of the axis aligned box from lo to hi
+def box_corners(lo, hi):
+    return [(x, y, z) for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])]
@@ -0,0 +1,154 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2011 Matt Ebb
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+
+# Scheduler for the renders of pre-passes, like shadow maps and point clouds.
+#
+# Jobs are started as soon as a slot is free and every job producing one of
+# their inputs has finished, so independent renders overlap, while later
+# passes only wait on the files they actually read. The renderer's threads
+# are split between the slots.
+#
+# Jobs are waited on from threads of their own, so nothing here, including
+# the on_done callbacks, may touch blender data.
+
+import subprocess
+import threading
+
+
+class RenderJob:
+    def __init__(self, name, cmd, cwd=None, outputs=(), depends=(), on_done=None):
+        self.name = name
+        self.cmd = cmd
+        self.cwd = cwd
+        self.outputs = set(outputs)
+        self.depends = list(depends)
+
+        # called with the job once it has finished, from the scheduler's thread
+        self.on_done = on_done
+
+        self.process = None
+        self.returncode = None
+
+    def done(self):
+        return self.returncode is not None
+
+    def failed(self):
+        return self.done() and self.returncode != 0
+
+
+class JobScheduler:
+    def __init__(self, slots=1, threads=1, thread_flag='-t'):
+        self.slots = max(1, slots)
+        self.threads = threads
+        self.thread_flag = thread_flag
+
+        self.jobs = []
+        self.running = 0
+        self.cancelled = False
+
+        self._lock = threading.Condition()
+
+    # renderer threads for each job, so running jobs share the total
+    def threads_per_job(self):
+        return max(1, self.threads // self.slots)
+
+    # Add a render to run once the jobs writing any of its inputs are done
+    def submit(self, name, cmd, cwd=None, outputs=(), inputs=(), on_done=None):
+        with self._lock:
+            inputs = set(inputs)
+            depends = [job for job in self.jobs if job.outputs & inputs]
+
+            job = RenderJob(name, cmd, cwd, outputs, depends, on_done)
+            self.jobs.append(job)
+            self._start_ready()
+
+        return job
+
+    # Wait for the jobs producing any of the given files. Returns False if
+    # the timeout ran out first, so callers can check for user breaks.
+    def wait_for(self, paths, timeout=None):
+        paths = set(paths)
+        with self._lock:
+            return self._lock.wait_for(
+                lambda: all(job.done() for job in self.jobs if job.outputs & paths), timeout)
+
+    def wait_all(self, timeout=None):
+        with self._lock:
+            return self._lock.wait_for(lambda: all(job.done() for job in self.jobs), timeout)
+
+    def kill(self):
+        with self._lock:
+            self.cancelled = True
+
+            for job in self.jobs:
+                if job.process != None and not job.done():
+                    try:
+                        job.process.kill()
+                    except OSError:
+                        pass
+                elif job.process == None:
+                    job.returncode = -1
+
+            self._lock.notify_all()
+
+    def failures(self):
+        return [job for job in self.jobs if job.failed()]
+
+    def _start_ready(self):
+        for job in self.jobs:
+            if self.running >= self.slots or self.cancelled:
+                break
+            if job.process != None or job.done():
+                continue
+            if not all(dep.done() for dep in job.depends):
+                continue
+
+            if any(dep.failed() for dep in job.depends):
+                print('Skipping %s, after a failed render it depends on' % job.name)
+                job.returncode = -1
+                self._lock.notify_all()
+                continue
+
+            cmd = [job.cmd[0], self.thread_flag, str(self.threads_per_job())] + job.cmd[1:]
+            job.process = subprocess.Popen(cmd, cwd=job.cwd)
+            self.running += 1
+
+            threading.Thread(target=self._wait_job, args=(job,), daemon=True).start()
+
+    def _wait_job(self, job):
+        returncode = job.process.wait()
+
+        with self._lock:
+            job.returncode = returncode
+            self.running -= 1
+
+            if returncode != 0:
+                print('Render of %s failed with exit code %d' % (job.name, returncode))
+            if job.on_done != None:
+                job.on_done(job)
+
+            self._start_ready()
+            self._lock.notify_all()
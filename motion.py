@@ -0,0 +1,253 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2011 Matt Ebb
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+
+# Storage for motion blur samples, collected in a pre-process before any RIB
+# is written.
+#
+# Numeric sample data is kept in typed arrays rather than python lists, and
+# samples are appended with their time, then sorted once when read back.
+# Once the store holds more than its memory budget, further arrays are
+# written out to a temporary file and read back through a memory map, so
+# heavy scenes don't need every object's samples in RAM at the same time.
+#
+# Samples are copied out of blender's data, so they stay valid after the
+# meshes they were read from are freed.
+
+import mmap
+import operator
+import tempfile
+from array import array
+
+# padding for spilled arrays, so every array starts on a double boundary
+SPILL_ALIGNMENT = 8
+
+
+# An array that has been written to the spill file
+class SpilledArray:
+    __slots__ = ('offset', 'typecode', 'nbytes')
+
+    def __init__(self, offset, typecode, nbytes):
+        self.offset = offset
+        self.typecode = typecode
+        self.nbytes = nbytes
+
+
+# Convert a list of numbers into a typed array, leaving anything else as is
+def typed_array(values, float_typecode='f'):
+    if isinstance(values, array):
+        return values
+    if isinstance(values, memoryview):
+        # copy views of another store's data, which may be closed before this one
+        return array(values.format, values)
+    if not isinstance(values, list) or \
+            not all(isinstance(v, (int, float)) for v in values):
+        return values
+
+    if all(isinstance(v, int) for v in values):
+        return array('i', values)
+    return array(float_typecode, values)
+
+
+# Compare two samples, or fields of samples, allowing numbers to differ by up
+# to tolerance. Works on typed arrays and memoryviews, and anything nested
+# that can be iterated, like matrices or lists of splines.
+def values_equal(a, b, tolerance=0.0):
+    if a is b:
+        return True
+    if a is None or b is None or isinstance(a, str) or isinstance(b, str):
+        return a == b
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return abs(a - b) <= tolerance
+
+    try:
+        if len(a) != len(b):
+            return False
+    except TypeError:
+        return a == b
+
+    if a == b:
+        return True
+    if tolerance <= 0.0:
+        return False
+
+    if isinstance(a, (array, memoryview)) and isinstance(b, (array, memoryview)):
+        return len(a) == 0 or max(map(abs, map(operator.sub, a, b))) <= tolerance
+
+    return all(values_equal(x, y, tolerance) for x, y in zip(a, b))
+
+
+class MotionStore:
+    def __init__(self, budget=0, directory=None, float_typecode='f'):
+        # bytes of array data kept in memory before spilling, 0 for no limit
+        self.budget = budget
+        self.directory = directory
+        self.float_typecode = float_typecode
+
+        self.nbytes = 0
+        self.spilled_bytes = 0
+
+        # name -> list of (time, sample)
+        self._samples = {}
+        self._unsorted = set()
+
+        # objects whose samples are all the same, which aren't really in motion
+        self._static = set()
+
+        self._spill_file = None
+        self._spill_size = 0
+        self._maps = []
+
+    def __contains__(self, name):
+        return name in self._samples and name not in self._static
+
+    def __len__(self):
+        return len(self._samples) - len(self._static)
+
+    def keys(self):
+        return [name for name in self._samples if name not in self._static]
+
+    # Add a sample of an object at a given (sub)frame time. Samples that are
+    # tuples get their numeric fields stored as typed arrays, anything else
+    # (matrices, lists of splines, ...) is kept as it is.
+    def add(self, name, time, sample):
+        if isinstance(sample, tuple):
+            sample = tuple(self._store(typed_array(field, self.float_typecode)) for field in sample)
+
+        samples = self._samples.setdefault(name, [])
+        if samples and time < samples[-1][0]:
+            self._unsorted.add(name)
+        samples.append((time, sample))
+
+    # samples of an object, in time order
+    def __getitem__(self, name):
+        return [sample for time, sample in self._sorted(name)]
+
+    def get(self, name, default=None):
+        if name not in self:
+            return default
+        return self[name]
+
+    def is_static(self, name, tolerance=0.0):
+        samples = self[name]
+        return all(values_equal(samples[0], sample, tolerance) for sample in samples[1:])
+
+    # Static objects are left out of the store as far as the exporter is concerned,
+    # so they're written without motion blur, but their samples can still be
+    # reused with sample_at()
+    def mark_static(self, name):
+        self._static.add(name)
+
+    def times(self, name):
+        return [time for time, sample in self._sorted(name)]
+
+    # the sample of an object at a given time, or None
+    def sample_at(self, name, time):
+        for t, sample in self._samples.get(name, []):
+            if t == time:
+                return self._load(sample)
+        return None
+
+    # spilled space isn't reclaimed, it only lasts as long as the store
+    def __delitem__(self, name):
+        del self._samples[name]
+        self._unsorted.discard(name)
+        self._static.discard(name)
+
+    def close(self):
+        self._samples = {}
+        self._unsorted = set()
+        self._static = set()
+
+        for m in self._maps:
+            try:
+                m.close()
+            except BufferError:
+                # views of it are still around, it'll be released along with them
+                pass
+        self._maps = []
+
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def stats_report(self):
+        return 'Motion samples: %.1f MB in memory, %.1f MB spilled to disk' % \
+            (self.nbytes / (1024.0*1024.0), self.spilled_bytes / (1024.0*1024.0))
+
+    def _sorted(self, name):
+        samples = self._samples[name]
+        if name in self._unsorted:
+            samples.sort(key=lambda item: item[0])
+            self._unsorted.discard(name)
+
+        return [(time, self._load(sample)) for time, sample in samples]
+
+    def _store(self, field):
+        if not isinstance(field, array):
+            return field
+
+        nbytes = field.itemsize * len(field)
+        if self.budget <= 0 or self.nbytes + nbytes <= self.budget or nbytes == 0:
+            self.nbytes += nbytes
+            return field
+
+        return self._spill(field)
+
+    def _spill(self, field):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix='motion_', dir=self.directory)
+
+        padding = -self._spill_size % SPILL_ALIGNMENT
+        if padding:
+            self._spill_file.write(bytes(padding))
+
+        offset = self._spill_size + padding
+        field.tofile(self._spill_file)
+
+        nbytes = field.itemsize * len(field)
+        self._spill_size = offset + nbytes
+        self.spilled_bytes += nbytes
+
+        return SpilledArray(offset, field.typecode, nbytes)
+
+    # zero-copy views of spilled arrays
+    def _load(self, sample):
+        if not isinstance(sample, tuple):
+            return sample
+        return tuple(self._view(field) if isinstance(field, SpilledArray) else field
+                     for field in sample)
+
+    def _view(self, spilled):
+        end = spilled.offset + spilled.nbytes
+
+        # map the file again once it has grown past the current map.
+        # older maps stay open while views of them might still be in use.
+        if not self._maps or len(self._maps[-1]) < end:
+            self._spill_file.flush()
+            self._maps.append(mmap.mmap(self._spill_file.fileno(), self._spill_size,
+                                        access=mmap.ACCESS_READ))
+
+        return memoryview(self._maps[-1])[spilled.offset:end].cast(spilled.typecode)
@@ -304,6 +304,26 @@ class RendermanSceneSettings(bpy.types.PropertyGroup):
                 name="Shading Rate",
                 description="Maximum distance between shading samples (lower = more detailed shading)",
                 default=1.0)
+    
+    shadingrate_adaptive = BoolProperty(
+                name="Adaptive Shading Rate",
+                description="Shade objects that are small on screen, or blurred by motion or depth of field, more coarsely. Objects with their own shading rate are left alone",
+                default=False)
+    
+    shadingrate_max = FloatProperty(
+                name="Max Shading Rate",
+                description="Coarsest shading rate given to any object",
+                min=0.01, default=8.0)
+    
+    shadingrate_size = FloatProperty(
+                name="Size",
+                description="Size on screen in pixels below which objects are shaded more coarsely",
+                min=1.0, default=32.0)
+    
+    shadingrate_blur = FloatProperty(
+                name="Blur",
+                description="Pixels of motion or depth of field blur that double an object's shading rate",
+                min=0.1, default=8.0)
 
     motion_blur = BoolProperty(
                 name="Motion Blur",
@@ -313,6 +333,27 @@ class RendermanSceneSettings(bpy.types.PropertyGroup):
                 name="Motion Segments",
                 description="Number of motion segments to take for multi-segment motion blur",
                 min=1, max=16, default=1)
+    velocity_blur = EnumProperty(
+                name="Velocity Blur",
+                description="Motion blur emitter particles and fluids from their velocity, instead of sampling their positions at each motion segment",
+                items=[('NONE', 'Sampled', 'Sample positions at each motion segment'),
+                       ('PRIMVAR', 'Velocity Primvar', 'Write a single sample with a dPdtime velocity primitive variable'),
+                       ('EXTRAPOLATE', 'Extrapolated', 'Write two samples, extrapolated over the shutter interval from the velocity')],
+                default='NONE')
+    motion_segments_adaptive = BoolProperty(
+                name="Adaptive Segments",
+                description="Choose the number of motion segments of each moving object from how far it deviates from a straight line, using Motion Segments as the maximum",
+                default=False)
+    motion_error_space = EnumProperty(
+                name="Error Space",
+                description="Space the adaptive motion segment error is measured in",
+                items=[('WORLD', 'World', 'Distance in world space units'),
+                       ('SCREEN', 'Screen', 'Distance in pixels, from the object\'s distance to the camera')],
+                default='SCREEN')
+    motion_error = FloatProperty(
+                name="Motion Error",
+                description="Largest distance an object may deviate from the straight lines between its motion samples",
+                min=0.0, default=0.5)
     shutter_open = FloatProperty(
                 name="Shutter Open",
                 description="Shutter open time",
@@ -330,6 +371,14 @@ class RendermanSceneSettings(bpy.types.PropertyGroup):
                 name="Close Efficiency",
                 description="Shutter close efficiency - controls the shape of the shutter opening and closing for motion blur",
                 default=0.5)
+    motion_tolerance = FloatProperty(
+                name="Static Tolerance",
+                description="Objects that move less than this over the shutter interval are exported without motion blur (0 = only if exactly the same)",
+                min=0.0, default=0.0, precision=5)
+    motion_memory = IntProperty(
+                name="Sample Memory (MB)",
+                description="Memory to use for motion blur samples before they are moved to temporary files on disk (0 = unlimited)",
+                min=0, default=1024)
 
     depth_of_field = BoolProperty(
                 name="Depth of Field",
@@ -388,6 +437,117 @@ class RendermanSceneSettings(bpy.types.PropertyGroup):
                 subtype='FILE_PATH',
                 default="$OUT/{scene}.rib")
     
+    rib_format = EnumProperty(
+                name="RIB Format",
+                description="Encoding of generated RIB files",
+                items=[('ASCII', 'ASCII', 'Human readable RIB text'),
+                    ('BINARY', 'Binary', 'Binary encoded RIB. Smaller files that are faster for the renderer to parse')],
+                default='ASCII')
+    
+    rib_compression = BoolProperty(
+                name="Compress RIB",
+                description="Write gzip compressed .rib.gz files for the main RIB, archives and shadow map/point cloud passes",
+                default=False)
+    
+    rib_compression_level = IntProperty(
+                name="Compression Level",
+                description="Gzip compression level (higher = smaller files, slower to write)",
+                min=1, max=9, default=6)
+    
+    rib_float_precision = IntProperty(
+                name="Float Precision",
+                description="Number of significant digits used when writing floating point geometry data to RIB",
+                min=3, max=9, default=7)
+    
+    fragment_cache = BoolProperty(
+                name="Cache Object RIB",
+                description="Keep each object's RIB in a cache across frames, and reference it with ReadArchive when nothing about the object has changed",
+                default=False)
+    
+    path_fragment_cache = StringProperty(
+                name="Cache Path",
+                description="Directory to store cached object RIB fragments",
+                subtype='DIR_PATH',
+                default="$OUT/fragments")
+    
+    fragment_cache_size = IntProperty(
+                name="Cache Size (MB)",
+                description="Maximum size of the object RIB cache. The least recently used fragments are removed when it grows larger than this",
+                min=1, default=1024)
+    
+    shadowmap_cache = BoolProperty(
+                name="Reuse Shadow Maps",
+                description="Skip rendering shadow maps whose RIB hasn't changed since they were last rendered, copying them from earlier frames when possible",
+                default=True)
+    
+    shadowmap_culling = BoolProperty(
+                name="Cull Shadow Casters",
+                description="Only export objects inside a lamp's spot cone or distant shadow window to its shadow map",
+                default=True)
+    
+    camera_culling = BoolProperty(
+                name="Cull Off-screen Objects",
+                description="Leave objects outside the camera view, allowing for motion blur and depth of field, out of the beauty pass. Only objects invisible to all ray types are culled",
+                default=False)
+    
+    prepass_jobs = IntProperty(
+                name="Pre-pass Jobs",
+                description="Number of shadow map and point cloud renders to run at the same time, sharing the render threads between them",
+                min=1, max=32, default=1)
+    export_processes = IntProperty(
+                name="Export Processes",
+                description="Number of worker processes that generate object RIB in parallel with data extraction. 1 exports everything on blender's main thread, 0 uses one process per CPU",
+                min=0, max=64, default=1)
+    
+    delayed_archives = BoolProperty(
+                name="Delayed Archives",
+                description="Write heavy objects to archives of their own, read with DelayedReadArchive only when the renderer reaches their bounds, to lower peak memory use",
+                default=False)
+    
+    delayed_archive_vertices = IntProperty(
+                name="Min Vertices",
+                description="Objects with at least this many vertices, counting render subdivision, are written to delayed archives",
+                min=1, default=100000)
+    
+    lod = BoolProperty(
+                name="Level of Detail",
+                description="Export heavy polygon meshes along with decimated versions, for the renderer to choose between by their size on screen",
+                default=False)
+    
+    lod_vertices = IntProperty(
+                name="Min Vertices",
+                description="Polygon meshes with at least this many vertices get decimated levels of detail",
+                min=1, default=10000)
+    
+    lod_levels = IntProperty(
+                name="Levels",
+                description="Number of decimated levels below the full detail mesh",
+                min=1, max=6, default=2)
+    
+    lod_ratio = FloatProperty(
+                name="Ratio",
+                description="Fraction of the faces kept from one level to the next",
+                min=0.01, max=0.9, default=0.25)
+    
+    lod_size = FloatProperty(
+                name="Full Detail Size",
+                description="Size on screen in pixels below which an object's first decimated level is used",
+                min=1.0, default=256.0)
+    
+    rib_shards = EnumProperty(
+                name="Split World",
+                description="Split the objects in the world block into separate RIB files, read from the main RIB. Only files whose contents changed are rewritten",
+                items=[('NONE', 'None', 'Write all objects into the main RIB file'),
+                    ('OBJECT', 'By Object', 'One file per object'),
+                    ('MATERIAL', 'By Material', "One file per material, from each object's first material"),
+                    ('SIZE', 'By Size', 'Fill each file with objects up to a maximum size')],
+                default='NONE')
+    
+    rib_shard_size = IntProperty(
+                name="Max Size (MB)",
+                description="Approximate maximum size of each file when splitting by size",
+                min=1, default=64)
+    
     output_action = EnumProperty(
                 name="Action",
                 description="Action to take when rendering",
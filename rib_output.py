@@ -0,0 +1,809 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2011 Matt Ebb
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+# RIB output helpers for large payloads.
+#
+# Kept free of any bpy imports, so it can be used outside of blender.
+
+import collections
+import gzip
+import hashlib
+import importlib
+import io
+import multiprocessing
+import os
+import queue
+import re
+import site
+import struct
+import sys
+import threading
+from array import array
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_PRECISION = 7
+DEFAULT_CHUNK_SIZE = 4096
+
+INTEGER_TYPECODES = 'bBhHiIlLqQ'
+
+
+def is_integer_array(values):
+    if isinstance(values, array):
+        return values.typecode in INTEGER_TYPECODES
+    if isinstance(values, memoryview):
+        return values.format in INTEGER_TYPECODES
+
+    return all(isinstance(v, int) for v in values)
+
+# raw bytes of a numeric sequence, for hashing
+def array_bytes(values):
+    if isinstance(values, (array, memoryview)):
+        return bytes(values)
+    return array('i' if is_integer_array(values) else 'd', values).tobytes()
+
+# cache of %-format strings, keyed by (value format, number of values)
+_chunk_formats = {}
+
+def chunk_format(fmt, count):
+    key = (fmt, count)
+    if key not in _chunk_formats:
+        _chunk_formats[key] = ' '.join([fmt] * count)
+    return _chunk_formats[key]
+
+def value_format(values, precision=DEFAULT_PRECISION):
+    if is_integer_array(values):
+        return '%d'
+    return '%%.%dg' % precision
+
+# Format a numeric sequence as RIB array text, one chunk at a time.
+# Each chunk is formatted with a single % operation rather than a
+# str() call per value, and the full array is never held as one string.
+def format_array_chunks(values, precision=DEFAULT_PRECISION, chunk_size=DEFAULT_CHUNK_SIZE):
+    fmt = value_format(values, precision)
+
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start+chunk_size]
+        yield chunk_format(fmt, len(chunk)) % tuple(chunk)
+
+# Write a numeric sequence (typed array, list or tuple) to file as a RIB array
+def write_array(file, values, precision=DEFAULT_PRECISION, chunk_size=DEFAULT_CHUNK_SIZE):
+    # encoders that handle raw numeric data themselves
+    if hasattr(file, 'write_array'):
+        file.write_array(values, precision)
+        return
+
+    file.write('[ ')
+
+    first = True
+    for text in format_array_chunks(values, precision, chunk_size):
+        if not first:
+            file.write(' ')
+        file.write(text)
+        first = False
+
+    file.write(' ]')
+
+
+# ------------- Binary RIB encoding -------------
+
+# Byte codes from the RIB binary encoding
+RIB_INTEGER = 0o200         # + width-1, for a 1-4 byte signed integer
+RIB_SHORT_STRING = 0o220    # + length, for strings of 0-15 bytes
+RIB_LONG_STRING = 0o240     # + width-1 of following length
+RIB_FLOAT = 0o244
+RIB_DOUBLE = 0o245
+RIB_REQUEST = 0o246         # followed by a previously defined request code
+RIB_FLOAT_ARRAY = 0o310     # + width-1 of following length
+RIB_DEFINE_REQUEST = 0o314  # code, then the request name as a string
+RIB_DEFINE_STRING = 0o315   # + width-1 of token, token, then the string
+RIB_STRING_TOKEN = 0o317    # + width-1 of token, interpolates a defined string
+
+MAX_REQUESTS = 256
+MAX_STRING_TOKENS = 65536
+
+_rib_token = re.compile(r'''
+    \s*(?:
+        (?P<comment>\#[^\n]*) |
+        (?P<string>"(?:[^"\\]|\\.)*") |
+        (?P<open>\[) |
+        (?P<close>\]) |
+        (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?) |
+        (?P<request>[A-Za-z_][A-Za-z0-9_]*) |
+        (?P<unterminated>") |
+        (?P<other>\S)
+    )''', re.VERBOSE)
+
+_string_escape = re.compile(r'\\(.)', re.DOTALL)
+_escape_chars = {'n':'\n', 't':'\t', 'r':'\r'}
+
+def _unescape(s):
+    return _string_escape.sub(lambda m: _escape_chars.get(m.group(1), m.group(1)), s)
+
+def _width(n):
+    if n < 0x100: return 1
+    if n < 0x10000: return 2
+    if n < 0x1000000: return 3
+    return 4
+
+def _to_big_endian(values):
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values.tobytes()
+
+# File-like object that accepts ASCII RIB text and writes it out
+# to a binary stream in the RIB binary encoding. Requests are encoded,
+# repeated strings become string tokens, numbers are stored as raw
+# integers/floats and numeric arrays as raw float arrays.
+#
+# With define=False no request or string token definitions are written,
+# for fragments that get spliced into another encoder's stream.
+class BinaryRibEncoder:
+    def __init__(self, stream, define=True):
+        self.stream = stream
+        self.define = define
+        self._pending = ''
+        self._array = None
+        self._requests = {}
+        self._strings = {}
+        self._string_counts = {}
+
+    @property
+    def name(self):
+        return self.stream.name
+
+    def write(self, text):
+        self._pending += text
+
+        # only tokenise complete lines, so tokens aren't split between writes
+        end = self._pending.rfind('\n') + 1
+        if end > 0:
+            self._encode_text(end)
+
+    def write_array(self, values, precision=DEFAULT_PRECISION):
+        self._encode_text(len(self._pending))
+
+        if is_integer_array(values):
+            self.stream.write(b'[' + b''.join(self._integer(v) for v in values) + b']')
+        else:
+            self.stream.write(self._float_array(array('f', values)))
+
+    # already encoded binary data
+    def write_encoded(self, data):
+        self._encode_text(len(self._pending))
+        self._close_array()
+        self.stream.write(data)
+
+    def flush(self):
+        self._encode_text(len(self._pending))
+        self._close_array()
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+
+    def _encode_text(self, end):
+        text = self._pending[:end]
+        pos = 0
+
+        while pos < len(text):
+            m = _rib_token.match(text, pos)
+            if m is None or m.lastgroup is None:
+                # only whitespace left
+                pos = len(text)
+                break
+
+            # a string continued in a later write
+            if m.lastgroup == 'unterminated' and end < len(self._pending):
+                pos = m.start(m.lastgroup)
+                break
+
+            self._encode_token(m.lastgroup, m.group(m.lastgroup))
+            pos = m.end()
+
+        self._pending = text[pos:] + self._pending[end:]
+
+    def _encode_token(self, kind, token):
+        if kind == 'comment':
+            return
+        elif kind == 'open':
+            self._close_array()
+            self._array = []
+        elif kind == 'close':
+            self._close_array(bracketed=True)
+        elif kind == 'number':
+            value = float(token) if any(c in token for c in '.eE') else int(token)
+            if self._array is not None:
+                self._array.append(value)
+            else:
+                self.stream.write(self._number(value))
+        else:
+            self._close_array()
+            if kind == 'string':
+                self.stream.write(self._interned_string(_unescape(token[1:-1])))
+            elif kind == 'request':
+                self.stream.write(self._request(token))
+            else:
+                self.stream.write(token.encode() + b' ')
+
+    # write out numbers collected in an open bracket. All-numeric arrays
+    # containing floats become a raw float array, anything else stays bracketed.
+    def _close_array(self, bracketed=False):
+        values = self._array
+        if values is None:
+            if bracketed:
+                self.stream.write(b']')
+            return
+        self._array = None
+
+        if bracketed and any(isinstance(v, float) for v in values):
+            self.stream.write(self._float_array(array('f', values)))
+        else:
+            self.stream.write(b'[' + b''.join(self._number(v) for v in values))
+            if bracketed:
+                self.stream.write(b']')
+
+    def _integer(self, value):
+        return bytes([RIB_INTEGER + 3]) + struct.pack('>i', value)
+
+    def _number(self, value):
+        if isinstance(value, int):
+            if -0x80 <= value < 0x80:
+                return bytes([RIB_INTEGER]) + struct.pack('>b', value)
+            elif -0x8000 <= value < 0x8000:
+                return bytes([RIB_INTEGER + 1]) + struct.pack('>h', value)
+            elif -0x80000000 <= value < 0x80000000:
+                return self._integer(value)
+            return bytes([RIB_DOUBLE]) + struct.pack('>d', value)
+
+        return bytes([RIB_FLOAT]) + struct.pack('>f', value)
+
+    def _float_array(self, values):
+        w = _width(len(values))
+        return bytes([RIB_FLOAT_ARRAY + w - 1]) + len(values).to_bytes(w, 'big') + _to_big_endian(values)
+
+    def _string(self, s):
+        data = s.encode()
+        if len(data) < 16:
+            return bytes([RIB_SHORT_STRING + len(data)]) + data
+
+        w = _width(len(data))
+        return bytes([RIB_LONG_STRING + w - 1]) + len(data).to_bytes(w, 'big') + data
+
+    # strings are written literally the first time they're seen,
+    # then defined as a string token on their second use
+    def _interned_string(self, s):
+        if not self.define:
+            return self._string(s)
+
+        if s in self._strings:
+            token = self._strings[s]
+            w = _width(token)
+            return bytes([RIB_STRING_TOKEN + w - 1]) + token.to_bytes(w, 'big')
+
+        count = self._string_counts.get(s, 0)
+        if count == 0 or len(self._strings) >= MAX_STRING_TOKENS:
+            self._string_counts[s] = count + 1
+            return self._string(s)
+
+        token = len(self._strings)
+        self._strings[s] = token
+        del self._string_counts[s]
+
+        w = _width(token)
+        return bytes([RIB_DEFINE_STRING + w - 1]) + token.to_bytes(w, 'big') + self._string(s) + \
+            bytes([RIB_STRING_TOKEN + w - 1]) + token.to_bytes(w, 'big')
+
+    def _request(self, name):
+        if name in self._requests:
+            return bytes([RIB_REQUEST, self._requests[name]])
+
+        if not self.define or len(self._requests) >= MAX_REQUESTS:
+            return name.encode() + b' '
+
+        code = len(self._requests)
+        self._requests[name] = code
+        return bytes([RIB_DEFINE_REQUEST, code]) + self._string(name) + bytes([RIB_REQUEST, code])
+
+
+# ------------- Compressed output -------------
+
+GZIP_EXTENSION = '.gz'
+GZIP_BLOCK_SIZE = 1 << 18
+GZIP_QUEUE_SIZE = 16
+
+# Writes a gzip compressed file, with the compression itself running on
+# a background thread. Small writes are gathered into larger blocks and
+# handed to the compression thread through a bounded queue, so the
+# exporter only stalls if it gets too far ahead of the compressor.
+class ThreadedGzipWriter:
+    def __init__(self, path, compresslevel=6):
+        self.name = path
+        self._file = open(path, 'wb')
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode='wb', compresslevel=compresslevel)
+        self._blocks = []
+        self._size = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=GZIP_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._compress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _compress(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                break
+            if self._error is None:
+                try:
+                    self._gzip.write(block)
+                except Exception as e:
+                    self._error = e
+
+    # accepts both text (ASCII RIB) and bytes (binary RIB)
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._blocks.append(data)
+        self._size += len(data)
+
+        if self._size >= GZIP_BLOCK_SIZE:
+            self._queue_blocks()
+
+    def _queue_blocks(self):
+        if self._error is not None:
+            raise self._error
+        if self._blocks:
+            self._queue.put(b''.join(self._blocks))
+        self._blocks = []
+        self._size = 0
+
+    def flush(self):
+        self._queue_blocks()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._queue_blocks()
+        self._queue.put(None)
+        self._thread.join()
+
+        self._gzip.close()
+        self._file.close()
+
+        if self._error is not None:
+            raise self._error
+
+def compressed_path(path):
+    if path.endswith(GZIP_EXTENSION):
+        return path
+    return path + GZIP_EXTENSION
+
+# Open the underlying output stream for a RIB file, either as plain ASCII text
+# or binary encoded, and optionally gzip compressed (compression level 1-9,
+# 0 for uncompressed)
+def open_rib_stream(path, binary=False, compression=0):
+    if compression > 0:
+        stream = ThreadedGzipWriter(path, compression)
+    elif binary:
+        stream = open(path, 'wb')
+    else:
+        return open(path, 'w')
+
+    if binary:
+        return BinaryRibEncoder(stream)
+    return stream
+
+def open_rib(path, binary=False, compression=0, precision=DEFAULT_PRECISION):
+    return RibWriter(open_rib_stream(path, binary, compression), precision)
+
+
+# ------------- RIB Writer -------------
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+INDENT = '    '
+
+def is_sequence(v):
+    return hasattr(v, '__len__') and not isinstance(v, str)
+
+# Format a single request argument or parameter value.
+# Strings are quoted, sequences become RIB arrays and sequences of
+# sequences (eg. a 4x4 matrix) are flattened column by column.
+def format_value(v, precision=DEFAULT_PRECISION):
+    if isinstance(v, str):
+        return '"%s"' % v
+    elif isinstance(v, bool):
+        return '%d' % v
+    elif isinstance(v, int):
+        return '%d' % v
+    elif isinstance(v, float):
+        return '%.*g' % (precision, v)
+    elif len(v) == 0:
+        return '[ ]'
+    elif is_sequence(v[0]):
+        columns = [v[r][c] for c in range(len(v[0])) for r in range(len(v))]
+        return '[ %s ]' % ' '.join(format_value(float(i), precision) for i in columns)
+    elif isinstance(v[0], str):
+        return '[ %s ]' % ' '.join('"%s"' % i for i in v)
+
+    return '[ %s ]' % ' '.join(format_array_chunks(v, precision))
+
+# Buffered writer for RIB output, used by all the export functions.
+#
+# Formats requests and parameter lists with consistent indentation,
+# gathers output into large blocks before passing it on to the
+# underlying stream, and keeps byte and request counts, in total and
+# per object. Numeric arrays are handed to binary encoders untouched.
+class RibWriter:
+    def __init__(self, stream, precision=DEFAULT_PRECISION, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.stream = stream
+        self.precision = precision
+        self.buffer_size = buffer_size
+        self.depth = 0
+
+        self.bytes_written = 0
+        self.requests_written = 0
+        self.object_stats = {}
+        self._objects = []
+
+        self._raw_arrays = hasattr(stream, 'write_array')
+        self._buffer = []
+        self._buffered = 0
+
+        # hashlib object that's also fed everything written, while it's set
+        self.digest = None
+
+    @property
+    def name(self):
+        return self.stream.name
+
+    # raw, unformatted RIB text
+    def write(self, text):
+        if self.digest is not None:
+            self.digest.update(text.encode())
+
+        self._buffer.append(text)
+        self._buffered += len(text)
+        self.bytes_written += len(text)
+
+        if self._buffered >= self.buffer_size:
+            self.flush_buffer()
+
+    def _line(self, text, depth=0):
+        self.write('%s%s\n' % (INDENT * (self.depth + depth), text))
+
+    def _args(self, args):
+        return ''.join(' ' + format_value(a, self.precision) for a in args)
+
+    def newline(self):
+        self.write('\n')
+
+    def comment(self, text):
+        self._line('# %s' % text)
+
+    # RIB request, with optional arguments, on a single line
+    def request(self, name, *args):
+        self.requests_written += 1
+        self._line(name + self._args(args))
+
+    # <block>Begin, indenting everything up to the matching end()
+    def begin(self, block, *args):
+        self.request(block + 'Begin', *args)
+        self.depth += 1
+
+    def end(self, block):
+        self.depth = max(self.depth - 1, 0)
+        self.request(block + 'End')
+
+    # parameter of the previous request, on its own line
+    def param(self, decl, *values):
+        self._line('"%s"%s' % (decl, self._args(values)), depth=1)
+
+    # parameter with a large numeric array value
+    def param_array(self, decl, values):
+        self.write('%s"%s" ' % (INDENT * (self.depth + 1), decl))
+        self.write_array(values, self.precision)
+        self.write('\n')
+
+    # positional numeric array argument of the previous request, on its own line
+    def array(self, values):
+        self.write(INDENT * (self.depth + 1))
+        self.write_array(values, self.precision)
+        self.write('\n')
+
+    # positional arguments of the previous request, on their own line
+    def arguments(self, *values):
+        self._line(self._args(values).lstrip(), depth=1)
+
+    # an empty writer at the same precision and indentation, recording
+    # its output for render_fragment() instead of writing it to a file
+    def recorder(self):
+        fragment = RibWriter(FragmentRecorder(self.name), self.precision)
+        fragment.depth = self.depth
+        return fragment
+
+    # write out a recording made by self.recorder(). The recording is only
+    # formatted once, however many times it's replayed.
+    def replay(self, recording):
+        recording.flush_buffer()
+
+        if self._raw_arrays:
+            for item in recording.stream.items:
+                if isinstance(item, str):
+                    self.write(item)
+                else:
+                    self.write_array(*item)
+        else:
+            self.write(recording.stream.text())
+
+    # output of render_fragment(), for a recording made by self.recorder()
+    def write_fragment(self, data, recording=None):
+        self.flush_buffer()
+
+        if self.digest is not None:
+            self.digest.update(data.encode() if isinstance(data, str) else data)
+
+        if hasattr(self.stream, 'write_encoded'):
+            self.stream.write_encoded(data)
+        else:
+            self.stream.write(data)
+        self.bytes_written += len(data)
+
+        if recording is not None:
+            self.merge_stats(recording)
+
+    # add the per-object statistics of a recording written elsewhere
+    def merge_stats(self, recording):
+        self.requests_written += recording.requests_written
+        for name, (nbytes, nrequests) in recording.object_stats.items():
+            self.add_object_stats(name, nbytes, nrequests)
+
+    # statistics of an object written to another file, eg. a cached fragment
+    def add_object_stats(self, name, nbytes, nrequests):
+        stats = self.object_stats.setdefault(name, [0, 0])
+        stats[0] += nbytes
+        stats[1] += nrequests
+
+    # numeric array, inline in the current line
+    def write_array(self, values, precision=None):
+        precision = self.precision if precision is None else precision
+
+        if self._raw_arrays:
+            if self.digest is not None:
+                self.digest.update(array_bytes(values))
+
+            self.flush_buffer()
+            self.stream.write_array(values, precision)
+            self.bytes_written += 4 * len(values)
+            return
+
+        self.write('[ ')
+        first = True
+        for text in format_array_chunks(values, precision):
+            if not first:
+                self.write(' ')
+            self.write(text)
+            first = False
+        self.write(' ]')
+
+    # per-object statistics
+    def begin_object(self, name):
+        self._objects.append((name, self.bytes_written, self.requests_written))
+
+    def end_object(self):
+        name, start_bytes, start_requests = self._objects.pop()
+        stats = self.object_stats.setdefault(name, [0, 0])
+        stats[0] += self.bytes_written - start_bytes
+        stats[1] += self.requests_written - start_requests
+
+    def stats_report(self, count=10):
+        lines = ['%s: %d bytes, %d requests' % (self.name, self.bytes_written, self.requests_written)]
+
+        heaviest = sorted(self.object_stats.items(), key=lambda i: i[1][0], reverse=True)
+        for name, (nbytes, nrequests) in heaviest[:count]:
+            lines.append('    %s: %d bytes, %d requests' % (name, nbytes, nrequests))
+        return '\n'.join(lines)
+
+    def flush_buffer(self):
+        if self._buffer:
+            self.stream.write(''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+    def flush(self):
+        self.flush_buffer()
+        self.stream.flush()
+
+    def close(self):
+        self.flush_buffer()
+        self.stream.close()
+
+
+# ------------- Parallel serialization -------------
+
+# Stream for RibWriter that keeps RIB text as it is and numeric arrays as
+# typed buffers, rather than writing them out. The resulting items are cheap
+# to send to another process, which does the formatting or binary encoding.
+class FragmentRecorder:
+    def __init__(self, name=''):
+        self.name = name
+        self.items = []
+        self._text = None
+
+    # the recording formatted as ASCII RIB
+    def text(self):
+        if self._text is None:
+            self._text = render_fragment(self.items)
+        return self._text
+
+    def write(self, text):
+        self._text = None
+        if self.items and isinstance(self.items[-1], str):
+            self.items[-1] += text
+        else:
+            self.items.append(text)
+
+    def write_array(self, values, precision=DEFAULT_PRECISION):
+        self._text = None
+        if not isinstance(values, array):
+            values = array('i' if is_integer_array(values) else 'd', values)
+        self.items.append((values, precision))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+# list with a file-like write(), for write_array()
+class _Parts(list):
+    write = list.append
+
+# Turn recorded items into RIB, as text or binary encoded bytes.
+# Runs in the worker processes.
+def render_fragment(items, binary=False, define=False):
+    if binary:
+        stream = io.BytesIO()
+        encoder = BinaryRibEncoder(stream, define=define)
+
+        for item in items:
+            if isinstance(item, str):
+                encoder.write(item)
+            else:
+                encoder.write_array(*item)
+        encoder.flush()
+
+        return stream.getvalue()
+
+    parts = _Parts()
+    for item in items:
+        if isinstance(item, str):
+            parts.append(item)
+        else:
+            write_array(parts, *item)
+    return ''.join(parts)
+
+DEFAULT_SHARD_THREADS = 8
+
+# Write recorded items out as a standalone RIB file, unless its contents
+# hash to the same fingerprint as last time. Returns the new fingerprint
+# and whether the file was written.
+def write_shard(path, items, binary=False, compression=0, fingerprint=None):
+    data = render_fragment(items, binary, define=True)
+    if not binary:
+        data = data.encode()
+
+    digest = hashlib.sha1(data).hexdigest()
+    if digest == fingerprint and os.path.exists(path):
+        return digest, False
+
+    if compression > 0:
+        f = gzip.open(path, 'wb', compresslevel=compression)
+    else:
+        f = open(path, 'wb')
+    with f:
+        f.write(data)
+
+    return digest, True
+
+# Write several shards at once, as (path, items, binary, compression, fingerprint)
+# tuples. Uses the worker processes if there's a pool, otherwise threads.
+def write_shards(jobs, pool=None):
+    if not jobs:
+        return []
+    if pool is not None:
+        return pool.write_shards(jobs)
+
+    threads = ThreadPool(min(len(jobs), DEFAULT_SHARD_THREADS))
+    try:
+        return threads.starmap(write_shard, jobs)
+    finally:
+        threads.close()
+        threads.join()
+
+# Pool of worker processes turning recorded fragments into RIB.
+#
+# Fragments are submitted in order and always written to the output file
+# in that same order, as soon as all earlier fragments are done. At most
+# max_pending fragments are in flight at once, to bound memory use.
+# A function of this module, as seen by FragmentPool workers. They import the
+# module under its own name, rather than as part of the addon package (which
+# needs bpy), so functions are unpickled there as getattr(rib_output, name).
+class WorkerModule:
+    def __reduce__(self):
+        return (importlib.import_module, ('rib_output',))
+
+
+class WorkerFunction:
+    def __init__(self, name):
+        self.name = name
+
+    def __reduce__(self):
+        return (getattr, (WorkerModule(), self.name))
+
+
+class FragmentPool:
+    def __init__(self, processes, binary=False, executable=None):
+        self.binary = binary
+        self.max_pending = processes * 4
+        self._pending = collections.deque()
+
+        self._render = WorkerFunction('render_fragment')
+        self._write_shard = WorkerFunction('write_shard')
+
+        # spawned rather than forked, since a fork would copy the whole
+        # multithreaded process the pool is started from. Only the workers
+        # get this module's directory on their sys.path
+        directory = os.path.dirname(os.path.abspath(__file__))
+        context = multiprocessing.get_context('spawn')
+        if executable:
+            context.set_executable(executable)
+        self._pool = context.Pool(processes, initializer=site.addsitedir, initargs=(directory,))
+
+    # hand a RibWriter made by file.recorder() to the workers
+    def submit(self, file, fragment):
+        fragment.flush_buffer()
+        result = self._pool.apply_async(self._render, (fragment.stream.items, self.binary))
+        self._pending.append((result, fragment))
+
+        while self._pending and (self._pending[0][0].ready() or len(self._pending) > self.max_pending):
+            self._write_next(file)
+
+    # write all remaining fragments
+    def drain(self, file):
+        while self._pending:
+            self._write_next(file)
+
+    def _write_next(self, file):
+        result, fragment = self._pending.popleft()
+        file.write_fragment(result.get(), fragment)
+
+    def write_shards(self, jobs):
+        return self._pool.starmap(self._write_shard, jobs)
+
+    def close(self):
+        self._pending.clear()
+        self._pool.close()
+        self._pool.join()
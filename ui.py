@@ -328,6 +328,12 @@ class RENDER_PT_3Delight_sampling(bpy.types.Panel):
         col.separator()
         
         col.prop(rm, "shadingrate")
+        col.prop(rm, "shadingrate_adaptive")
+        sub = col.column(align=True)
+        sub.active = rm.shadingrate_adaptive
+        sub.prop(rm, "shadingrate_max")
+        sub.prop(rm, "shadingrate_size")
+        sub.prop(rm, "shadingrate_blur")
         
         col = split.column()
         col.prop(rm, "depth_of_field")
@@ -342,6 +348,13 @@ class RENDER_PT_3Delight_sampling(bpy.types.Panel):
         sub.enabled = rm.motion_blur
         sub.prop(rm, "motion_segments")
         
+        scol = sub.column(align=True)
+        scol.prop(rm, "motion_segments_adaptive")
+        ssub = scol.column(align=True)
+        ssub.active = rm.motion_segments_adaptive
+        ssub.prop(rm, "motion_error_space", text="")
+        ssub.prop(rm, "motion_error")
+        
         scol = sub.column(align=True)
         scol.prop(rm, "shutter_open")
         scol.prop(rm, "shutter_close")
@@ -349,6 +362,10 @@ class RENDER_PT_3Delight_sampling(bpy.types.Panel):
         scol = sub.column(align=True)
         scol.prop(rm, "shutter_efficiency_open")
         scol.prop(rm, "shutter_efficiency_close")
+        
+        sub.prop(rm, "velocity_blur")
+        sub.prop(rm, "motion_tolerance")
+        sub.prop(rm, "motion_memory")
 
 class MESH_PT_3Delight_prim_vars(CollectionPanel, bpy.types.Panel):
     bl_context = "data"
@@ -402,6 +419,46 @@ class RENDER_PT_renderman_output(bpy.types.Panel):
         rm = scene.renderman
         
         layout.prop(rm, "path_rib_output")
+        layout.prop(rm, "rib_format")
+        row = layout.row()
+        row.active = rm.rib_format == 'ASCII'
+        row.prop(rm, "rib_float_precision")
+        
+        row = layout.row()
+        row.prop(rm, "rib_compression")
+        sub = row.row()
+        sub.active = rm.rib_compression
+        sub.prop(rm, "rib_compression_level")
+        
+        layout.prop(rm, "fragment_cache")
+        col = layout.column()
+        col.active = rm.fragment_cache
+        col.prop(rm, "path_fragment_cache")
+        col.prop(rm, "fragment_cache_size")
+        layout.prop(rm, "shadowmap_cache")
+        layout.prop(rm, "shadowmap_culling")
+        layout.prop(rm, "camera_culling")
+        layout.prop(rm, "export_processes")
+        
+        row = layout.row()
+        row.prop(rm, "delayed_archives")
+        sub = row.row()
+        sub.active = rm.delayed_archives
+        sub.prop(rm, "delayed_archive_vertices")
+        
+        layout.prop(rm, "lod")
+        col = layout.column(align=True)
+        col.active = rm.lod
+        col.prop(rm, "lod_vertices")
+        col.prop(rm, "lod_levels")
+        col.prop(rm, "lod_ratio")
+        col.prop(rm, "lod_size")
+        
+        row = layout.row()
+        row.prop(rm, "rib_shards")
+        sub = row.row()
+        sub.active = rm.rib_shards == 'SIZE'
+        sub.prop(rm, "rib_shard_size")
         layout.prop(rm, "output_action")
         layout.prop(rm, "display_driver")
         if rm.display_driver not in ('idisplay', 'AUTO'):
@@ -570,6 +627,7 @@ class RENDER_PT_3Delight_performance(bpy.types.Panel):
         split = layout.split()
         col = split.column()
         col.prop(rm, "threads")
+        col.prop(rm, "prepass_jobs")
         col.prop(rm, "max_trace_depth")
         col.prop(rm, "max_specular_depth")
         col.prop(rm, "max_diffuse_depth")
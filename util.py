@@ -28,6 +28,7 @@ import mathutils
 import re
 import os
 import platform
+from array import array
 
 
 class BlenderVersionError(Exception):
@@ -205,8 +206,8 @@ def rib(v):
     elif type(v) == str:
         return '"%s"' % v
         
-    # list, tuple
-    elif type(v) in (list, tuple):
+    # list, tuple, typed array
+    elif type(v) in (list, tuple, array):
         return "[ " + " ".join(str(i) for i in v) + " ]"
     
     # matrix
@@ -219,11 +220,64 @@ def rib(v):
 
     
 
+# RIB bounds [xmin xmax ymin ymax zmin zmax] around a list of corners, such as ob.bound_box
 def rib_ob_bounds(ob_bb):
-    return ( ob_bb[0][0], ob_bb[7][0], bb[0][1], ob_bb[7][1], bb[0][2], ob_bb[7][2] )
+    lo = [min(c[i] for c in ob_bb) for i in range(3)]
+    hi = [max(c[i] for c in ob_bb) for i in range(3)]
+    return [lo[0], hi[0], lo[1], hi[1], lo[2], hi[2]]
 
 def rib_path(path, escape_slashes=False):
     return path_win_to_unixy(bpy.path.abspath(path), escape_slashes=escape_slashes)
+
+
+# ------------- Fingerprinting -------------
+
+# properties that change without changing anything rendered
+VOLATILE_PROPERTIES = {'rna_type', 'users', 'is_updated', 'is_updated_data'}
+
+# node editor layout and selection
+VOLATILE_NODE_PROPERTIES = {'location', 'select', 'width', 'width_hidden', 'height',
+                            'dimensions', 'hide', 'show_options', 'show_preview'}
+
+# Feed all RNA properties of a struct into a hashlib hash object, recursing
+# into nested structs and collections. ID datablocks are referenced by name
+# only, and structs already visited are skipped to avoid following cycles.
+def rna_fingerprint(h, ptr, visited=None):
+    if visited is None:
+        visited = set()
+    
+    if ptr is None:
+        h.update(b'None')
+        return
+    if ptr.as_pointer() in visited:
+        return
+    visited.add(ptr.as_pointer())
+    
+    is_node = isinstance(ptr, bpy.types.Node)
+    
+    for prop in ptr.bl_rna.properties:
+        id = prop.identifier
+        if id in VOLATILE_PROPERTIES:
+            continue
+        if is_node and id in VOLATILE_NODE_PROPERTIES:
+            continue
+        
+        value = getattr(ptr, id, None)
+        h.update(id.encode())
+        
+        if prop.type in ('POINTER', 'COLLECTION'):
+            items = value if prop.type == 'COLLECTION' else [value]
+            for item in items:
+                if isinstance(item, bpy.types.ID):
+                    h.update(item.name.encode())
+                else:
+                    rna_fingerprint(h, item, visited)
+        else:
+            if isinstance(value, set):
+                value = sorted(value)
+            elif getattr(prop, 'array_length', 0) > 0:
+                value = tuple(value)
+            h.update(repr(value).encode())
     
     
      